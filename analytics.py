@@ -0,0 +1,424 @@
+""" analytics database functions """
+
+import collections
+import json
+import sqlite3
+from itertools import repeat
+import pandas as pd
+
+import pipeline
+import metrics
+from storage import load_tables, read_column, source_stamp
+
+"""
+FUNCTIONS TO INGEST DATA
+
+The normalized tables of the raw data files (see storage.load_tables) are ingested into a SQLite database,
+with one row per patent, inventor, assignee and citation, so that any question can be answered with a SQL query
+instead of another pass over the raw data. Patents are numbered in the order of the files, as preprocessed by preprocess_data().
+
+The values carried from one patent to the next by aggregate_patent() (inventor location and citation of the last patent
+which has one) are computed once when a year is ingested, in the carried table. The views below apply the same rules
+as the preprocessing to discard patents, inventors and assignees, e.g.
+
+    SELECT year, organization, inventors FROM assignee_years WHERE type = '2' AND year BETWEEN 1990 AND 2000
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS years (year INTEGER PRIMARY KEY, stamp TEXT);
+CREATE TABLE IF NOT EXISTS patents (patent INTEGER PRIMARY KEY, year INTEGER, file TEXT, patent_number TEXT, patent_type TEXT);
+CREATE TABLE IF NOT EXISTS inventors (inventor INTEGER PRIMARY KEY, patent INTEGER, inventor_key_id TEXT,
+                                      inventor_latitude TEXT, inventor_longitude TEXT, latitude REAL, longitude REAL);
+CREATE TABLE IF NOT EXISTS assignees (assignee INTEGER PRIMARY KEY, patent INTEGER, assignee_key_id TEXT,
+                                      assignee_organization TEXT, assignee_type TEXT);
+CREATE TABLE IF NOT EXISTS citations (citation INTEGER PRIMARY KEY, patent INTEGER, cited_patent_number TEXT);
+CREATE TABLE IF NOT EXISTS carried (patent INTEGER PRIMARY KEY, year INTEGER, latitude REAL, longitude REAL, cited INTEGER);
+
+CREATE INDEX IF NOT EXISTS patents_year ON patents (year);
+CREATE INDEX IF NOT EXISTS patents_patent_number ON patents (patent_number);
+CREATE INDEX IF NOT EXISTS inventors_patent ON inventors (patent);
+CREATE INDEX IF NOT EXISTS inventors_key ON inventors (inventor_key_id);
+CREATE INDEX IF NOT EXISTS assignees_patent ON assignees (patent);
+CREATE INDEX IF NOT EXISTS assignees_key ON assignees (assignee_key_id);
+CREATE INDEX IF NOT EXISTS assignees_organization ON assignees (assignee_organization);
+CREATE INDEX IF NOT EXISTS citations_patent ON citations (patent);
+CREATE INDEX IF NOT EXISTS citations_cited ON citations (cited_patent_number);
+CREATE INDEX IF NOT EXISTS carried_year ON carried (year);
+
+-- reissue patents and patents without a type are discarded
+CREATE VIEW IF NOT EXISTS valid_patents AS
+    SELECT * FROM patents WHERE patent_type IS NOT NULL AND patent_type NOT IN ('', 'reissue');
+
+-- inventors of the valid patents, valid when they have a key and a location
+CREATE VIEW IF NOT EXISTS inventor_rows AS
+    SELECT i.*, p.year,
+           (i.inventor_latitude IS NOT NULL AND i.inventor_latitude != '0.1' AND i.inventor_key_id IS NOT NULL AND i.inventor_key_id != '') AS valid
+    FROM inventors i JOIN valid_patents p USING (patent);
+
+-- assignees of the valid patents, valid when they have a key and a type
+CREATE VIEW IF NOT EXISTS assignee_rows AS
+    SELECT a.*, p.year,
+           (a.assignee_key_id IS NOT NULL AND a.assignee_key_id != '' AND a.assignee_type IS NOT NULL AND a.assignee_type != '') AS valid
+    FROM assignees a JOIN valid_patents p USING (patent);
+
+-- valid assignees, with the inventor location and citation credited to them (NULL before the first one of the year)
+CREATE VIEW IF NOT EXISTS assignee_credits AS
+    SELECT a.assignee, a.patent, a.year, a.assignee_key_id, a.assignee_organization, a.assignee_type, c.latitude, c.longitude, c.cited
+    FROM assignee_rows a JOIN carried c USING (patent) WHERE a.valid;
+
+-- statistics of each assignee in each year, with the organization and type of its first appearance
+CREATE VIEW IF NOT EXISTS assignee_years AS
+    SELECT s.year, s.assignee_key_id, a.assignee_organization AS organization, a.assignee_type AS type,
+           s.inventors, s.patents, s.citations, s.first
+    FROM (SELECT year, assignee_key_id, COUNT(latitude) AS inventors, COUNT(*) AS patents,
+                 COALESCE(SUM(cited), 0) AS citations, MIN(assignee) AS first
+          FROM assignee_credits GROUP BY year, assignee_key_id) s
+    JOIN assignees a ON a.assignee = s.first;
+"""
+
+# values carried from one patent to the next, for the patents of one year (see aggregate_patent and pipeline.last_of_patent).
+# Rows are numbered in the order of the patents, so the last row of the closest previous patent which has one is the running maximum.
+CARRY_QUERY = """
+WITH last_rows AS (SELECT p.patent,
+                          (SELECT MAX(i.inventor) FROM inventors i WHERE i.patent = p.patent AND i.inventor_latitude IS NOT NULL
+                           AND i.inventor_latitude != '0.1' AND i.inventor_key_id IS NOT NULL AND i.inventor_key_id != '') AS inventor,
+                          (SELECT MAX(c.citation) FROM citations c WHERE c.patent = p.patent) AS citation
+                   FROM valid_patents p WHERE p.year = :year),
+     carried_rows AS (SELECT patent, MAX(inventor) OVER previous AS inventor, MAX(citation) OVER previous AS citation
+                      FROM last_rows WINDOW previous AS (ORDER BY patent ROWS UNBOUNDED PRECEDING))
+INSERT INTO carried
+SELECT r.patent, :year, i.latitude, i.longitude,
+       CASE WHEN c.citation IS NULL THEN NULL ELSE (c.cited_patent_number IS NOT NULL AND c.cited_patent_number != '') END
+FROM carried_rows r LEFT JOIN inventors i ON i.inventor = r.inventor LEFT JOIN citations c ON c.citation = r.citation
+"""
+
+
+def connect(database):
+    """
+    Opens the analytics database, creating its tables and views if needed
+
+    Inputs
+    :database: string type, path to the SQLite database
+
+    Outputs
+    :db: sqlite3.Connection
+    """
+    db = sqlite3.connect(database)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.executescript(SCHEMA)
+
+    return db
+
+
+def delete_year(db, year):
+    """
+    Deletes all the rows of a year from the database
+
+    Inputs
+    :db: as returned by connect()
+    :year: int
+    """
+    for table in ['inventors', 'assignees', 'citations']:
+        db.execute('DELETE FROM ' + table + ' WHERE patent IN (SELECT patent FROM patents WHERE year = ?)', (year,))
+    for table in ['carried', 'patents', 'years']:
+        db.execute('DELETE FROM ' + table + ' WHERE year = ?', (year,))
+
+
+def to_float(values):
+    """
+    Converts a string column of coordinates to floats, as aggregate_patent() does, with None for missing values
+    """
+    return [float(value) if (value) else None for value in values]
+
+
+@metrics.timed('ingest')
+def ingest_year(db, year, files, stream = False):
+    """
+    Ingests the raw data files of a year into the database. The year is only ingested again when its files change,
+    and then replaces the rows ingested before.
+
+    Inputs
+    :db: as returned by connect()
+    :year: string type or int, year of the data
+    :files: list of the raw data files of the year, in order (see pipeline.get_full_year_data)
+    :stream: if True, the raw data files are parsed incrementally when they need to be normalized (see storage.load_tables)
+
+    Outputs
+    :ingested: bool, False if the year was already ingested from the same files
+    """
+    year = int(year)
+    stamp = json.dumps([[file_, source_stamp(file_)] for file_ in files])
+    row = db.execute('SELECT stamp FROM years WHERE year = ?', (year,)).fetchone()
+    if (row != None) and (row[0] == stamp):
+        return False
+
+    print('ingesting', year)
+    with db:
+        delete_year(db, year)
+        first = db.execute('SELECT COALESCE(MAX(patent), 0) + 1 FROM patents').fetchone()[0]
+
+        for file_ in files:
+            tables = load_tables(file_, stream)
+            # the patents of the file are numbered from first, and the rows of the other tables refer to that number
+            num_patents = len(read_column(tables, 'patents.patent_type'))
+            rows = {table : (read_column(tables, table + '.patent') + first).tolist() for table in ['inventors', 'assignees', 'citations']}
+
+            db.executemany('INSERT INTO patents VALUES (?, ?, ?, ?, ?)',
+                           zip(range(first, first + num_patents), repeat(year), repeat(file_),
+                               read_column(tables, 'patents.patent_number').tolist(), read_column(tables, 'patents.patent_type').tolist()))
+
+            latitude = read_column(tables, 'inventors.inventor_latitude').tolist()
+            longitude = read_column(tables, 'inventors.inventor_longitude').tolist()
+            db.executemany('INSERT INTO inventors (patent, inventor_key_id, inventor_latitude, inventor_longitude, latitude, longitude) VALUES (?, ?, ?, ?, ?, ?)',
+                           zip(rows['inventors'], read_column(tables, 'inventors.inventor_key_id').tolist(), latitude, longitude,
+                               to_float(latitude), to_float(longitude)))
+
+            db.executemany('INSERT INTO assignees (patent, assignee_key_id, assignee_organization, assignee_type) VALUES (?, ?, ?, ?)',
+                           zip(rows['assignees'], *[read_column(tables, 'assignees.' + column).tolist()
+                                                    for column in ['assignee_key_id', 'assignee_organization', 'assignee_type']]))
+
+            db.executemany('INSERT INTO citations (patent, cited_patent_number) VALUES (?, ?)',
+                           zip(rows['citations'], read_column(tables, 'citations.cited_patent_number').tolist()))
+
+            first += num_patents
+            tables.close()
+
+        db.execute(CARRY_QUERY, {'year' : year})
+        db.execute('INSERT INTO years VALUES (?, ?)', (year, stamp))
+
+    return True
+
+
+def query(db, sql, params = ()):
+    """
+    Runs a SQL query on the database
+
+    Inputs
+    :db: as returned by connect()
+    :sql: string type, SQL query, over the tables and views of SCHEMA
+    :params: (optional) parameters of the query
+
+    Outputs
+    :result: DataFrame
+    """
+    return pd.read_sql_query(sql, db, params = params)
+
+
+"""
+FUNCTIONS TO QUERY DATA
+
+The functions below return the same results as those of the pipeline, from the database instead of the preprocessed data.
+"""
+
+def year_aggregates(db, year):
+    """
+    Fills the accumulators of a year with SQL queries, as aggregate_tables() does with group-bys
+
+    Inputs
+    :db: as returned by connect()
+    :year: string type or int
+
+    Outputs
+    :agg: accumulators, in the same format as filled by aggregate_patent()
+    """
+    year = int(year)
+    agg = pipeline.init_aggregates()
+
+    # patent types and locations are listed in order of first appearance
+    for patent_type, count in db.execute('SELECT patent_type, COUNT(*) FROM valid_patents WHERE year = ? GROUP BY patent_type ORDER BY MIN(patent)', (year,)):
+        agg['patent_type_count'][patent_type] = count
+    agg['discarded_patents'] = db.execute('SELECT COUNT(*) FROM patents WHERE year = ?', (year,)).fetchone()[0] - sum(agg['patent_type_count'].values())
+
+    for latitude, longitude, count in db.execute('SELECT latitude, longitude, COUNT(*) FROM inventor_rows WHERE year = ? AND valid '
+                                                 'GROUP BY latitude, longitude ORDER BY MIN(inventor)', (year,)):
+        agg['location_index'][(latitude, longitude)] = len(agg['location_keys'])
+        agg['location_keys'].append((latitude, longitude))
+        agg['location_count'].append(count)
+
+    agg['inventor_keys'] = set(key for key, in db.execute('SELECT DISTINCT inventor_key_id FROM inventor_rows WHERE year = ? AND valid', (year,)))
+    agg['discarded_inventors'] = set(key for key, in db.execute('SELECT DISTINCT inventor_key_id FROM inventor_rows WHERE year = ? AND NOT valid', (year,)))
+    agg['discarded_assignees'] = set(key for key, in db.execute('SELECT DISTINCT assignee_key_id FROM assignee_rows WHERE year = ? AND NOT valid', (year,)))
+
+    agg['cited_patents'] = set(number for number, in db.execute('SELECT DISTINCT c.cited_patent_number FROM citations c JOIN valid_patents p USING (patent) '
+                                                                "WHERE p.year = ? AND c.cited_patent_number IS NOT NULL AND c.cited_patent_number != ''", (year,)))
+    agg['discarded_citations'] = db.execute('SELECT COUNT(*) FROM citations c JOIN valid_patents p USING (patent) '
+                                            "WHERE p.year = ? AND (c.cited_patent_number IS NULL OR c.cited_patent_number = '')", (year,)).fetchone()[0]
+
+    for key, organization, assignee_type, patents, citations in db.execute('SELECT assignee_key_id, organization, type, patents, citations '
+                                                                            'FROM assignee_years WHERE year = ? ORDER BY first', (year,)):
+        agg['assignee_index'][key] = len(agg['assignee_key_id'])
+        agg['assignee_key_id'].append(key)
+        agg['assignee_org'].append(organization)
+        agg['assignee_type'].append(assignee_type)
+        agg['assignee_patents_count'].append(patents)
+        agg['assignee_cited_patents_count'].append(citations)
+
+    for key, latitude, longitude, count in db.execute('SELECT assignee_key_id, latitude, longitude, COUNT(*) FROM assignee_credits '
+                                                      'WHERE year = ? AND latitude IS NOT NULL GROUP BY assignee_key_id, latitude, longitude', (year,)):
+        agg['assignee_locations'][(agg['assignee_index'][key], agg['location_index'][(latitude, longitude)])] = count
+
+    return agg
+
+
+def get_years(db):
+    """
+    Returns the years ingested in the database
+
+    Outputs
+    :years: list of int
+    """
+    return [year for year, in db.execute('SELECT year FROM years ORDER BY year')]
+
+
+def load_data(year_range, data_dir, database, stream = False, adaptive = False, compress = False):
+    """
+    Same as pipeline.load_data(), but the data of each year is ingested into the analytics database,
+    and then preprocessed with SQL queries (see year_aggregates) instead of a pass over the raw data.
+
+    Inputs
+    :year_range: range type, range of years for which data is needed
+    :data_dir: string type, local directory for loading saved data / saving new data
+    :database: string type, path to the analytics database (see connect)
+    :stream: if True, the saved json data is parsed incrementally when it is ingested
+    :adaptive: if True, each year is fetched in windows which fit under the query limit (see pipeline.get_full_year_data)
+    :compress: if True, new data is saved as gzip compressed json lines (see pipeline.get_full_year_data)
+
+    Outputs
+    :full_year_data: preprocessed data, as returned by pipeline.load_data()
+    """
+    years = [str(year) for year in year_range]
+    datafiles = [pipeline.get_full_year_data(year, data_dir, adaptive = adaptive, compress = compress) for year in years]
+
+    db = connect(database)
+    for year, files in zip(years, datafiles):
+        ingest_year(db, year, files, stream)
+
+    full_year_data = {year : pipeline.format_aggregates(year_aggregates(db, year)) for year in years}
+    db.close()
+
+    return full_year_data
+
+
+def get_metrics_table(db):
+    """
+    Returns the summary metrics of all the years of the database, as pipeline.get_metrics_table()
+
+    Inputs
+    :db: as returned by connect()
+
+    Outputs
+    :metrics_table: DataFrame indexed by year, one column per metric, 0 for the assignee types absent from a year
+    """
+    counts = collections.defaultdict(dict)
+
+    def add(sql):
+        for row in query(db, sql).to_dict('records'):
+            counts[row.pop('year')].update(row)
+
+    add("SELECT year, COUNT(*) AS patents, SUM(patent_type = 'utility') AS utility_patents, SUM(patent_type = 'design') AS design_patents "
+        'FROM valid_patents GROUP BY year')
+    add("SELECT p.year, COUNT(DISTINCT CASE WHEN c.cited_patent_number != '' THEN c.cited_patent_number END) AS citations, "
+        "SUM(c.cited_patent_number IS NULL OR c.cited_patent_number = '') AS discarded_citations "
+        'FROM citations c JOIN valid_patents p USING (patent) GROUP BY p.year')
+    # the discarded keys are counted as a set, in which a missing key counts once
+    add('SELECT year, COUNT(DISTINCT CASE WHEN valid THEN inventor_key_id END) AS inventors, '
+        'COUNT(DISTINCT CASE WHEN NOT valid THEN inventor_key_id END) + MAX(NOT valid AND inventor_key_id IS NULL) AS discarded_inventors '
+        'FROM inventor_rows GROUP BY year')
+    add('SELECT year, COUNT(DISTINCT CASE WHEN NOT valid THEN assignee_key_id END) + MAX(NOT valid AND assignee_key_id IS NULL) AS discarded_assignees '
+        'FROM assignee_rows GROUP BY year')
+    add('SELECT year, COUNT(*) AS assignees FROM assignee_years GROUP BY year')
+    add("SELECT year, COUNT(*) - SUM(patent_type IS NOT NULL AND patent_type NOT IN ('', 'reissue')) AS discarded_patents FROM patents GROUP BY year")
+    types = query(db, 'SELECT year, type, COUNT(*) AS assignees FROM assignee_years GROUP BY year, type ORDER BY year, type')
+
+    metrics_table = {}
+    for year in get_years(db):
+        row = counts[year]
+        num_patents = int(row.get('patents', 0))
+        year_types = types[types['year'] == year].set_index('type')['assignees']
+
+        # same metrics, in the same order, as pipeline.compute_metrics()
+        metrics_table[year] = {'patents' : num_patents,
+                               'utility_patents' : int(row.get('utility_patents', 0)),
+                               'design_patents' : int(row.get('design_patents', 0)),
+                               'citations' : int(row.get('citations', 0)),
+                               'inventors' : int(row.get('inventors', 0)),
+                               'assignees' : int(row.get('assignees', 0)),
+                               'individuals' : int(year_types.get('4', 0) + year_types.get('5', 0)),
+                               'citations_per_patent' : row.get('citations', 0) / num_patents if num_patents else float('nan'),
+                               'inventors_per_patent' : row.get('inventors', 0) / num_patents if num_patents else float('nan')}
+        metrics_table[year]['other_patents'] = num_patents - metrics_table[year]['utility_patents'] - metrics_table[year]['design_patents']
+        for assignee_type in year_types.index:
+            metrics_table[year]['assignees_type_' + str(assignee_type)] = int(year_types[assignee_type])
+        for name in ['patents', 'citations', 'assignees', 'inventors']:
+            metrics_table[year]['discarded_' + name] = int(row.get('discarded_' + name, 0))
+
+    metrics_table = pd.DataFrame.from_dict(metrics_table, orient = 'index')
+    metrics_table.index.name = 'year'
+
+    assignee_types = [column for column in metrics_table.columns if column.startswith('assignees_type_')]
+    metrics_table[assignee_types] = metrics_table[assignee_types].fillna(0).astype(int)
+
+    return metrics_table
+
+
+def get_ts(db, metrics_table = None):
+    """
+    Extracts time series data from the database, as pipeline.get_ts()
+
+    Inputs
+    :db: as returned by connect()
+    :metrics_table: (optional) as returned by get_metrics_table, to avoid querying it again
+
+    Outputs
+    :ts: the time series returned by pipeline.get_ts()
+    """
+    if (metrics_table is None):
+        metrics_table = get_metrics_table(db)
+
+    return pipeline.get_ts(None, metrics_table)
+
+
+def get_assignee_table(db, assignees = None):
+    """
+    Returns the per-year statistics of the assignees, as pipeline.get_assignee_table().
+    When an organization appears several times in the same year, only the row with the most patents is kept
+    (the first one to appear in case of a tie).
+
+    Inputs
+    :db: as returned by connect()
+    :assignees: (optional) list of the organizations to return, all of them by default
+
+    Outputs
+    :table: DataFrame indexed by (year, organization), columns ['inventors', 'patents', 'citations']
+    """
+    sql = ('SELECT year, organization, inventors, patents, citations FROM '
+           '(SELECT *, ROW_NUMBER() OVER (PARTITION BY year, organization ORDER BY patents DESC, first) AS rank '
+           ' FROM assignee_years WHERE organization IS NOT NULL{}) '
+           'WHERE rank = 1')
+    if (assignees == None):
+        table = query(db, sql.format(''))
+    else:
+        table = query(db, sql.format(' AND organization IN (' + ', '.join(['?'] * len(assignees)) + ')'), list(assignees))
+
+    return table.set_index(['year', 'organization']).sort_index()
+
+
+def get_assignee_ts(db, assignees, table = None):
+    """
+    Returns the time series of the number of inventors for the specified assignees, as pipeline.get_assignee_ts()
+
+    Inputs
+    :db: as returned by connect()
+    :assignees: list of assignees for which to get the time series
+    :table: (optional) as returned by get_assignee_table, to avoid querying it again for each call
+
+    Outputs
+    :ts: DataFrame indexed by year, one column per assignee, 0 for the years without data for an assignee
+    """
+    if (table is None):
+        table = get_assignee_table(db, assignees)
+
+    ts = table['inventors'].unstack('organization').reindex(index = get_years(db), columns = assignees).fillna(0).astype(int)
+    ts.columns.name = None
+
+    return ts
@@ -0,0 +1,318 @@
+""" benchmark functions """
+
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import random
+import time
+import tracemalloc
+import numpy as np
+
+from pipeline import preprocess_data, preprocess_layer_data, get_top_k_locations, get_assignee_ts, get_assignee_table
+from storage import cache_file, load_tables
+from similarity import compare_networks, minhash_error
+
+"""
+FUNCTIONS TO GENERATE SYNTHETIC DATA
+
+The synthetic data has the same format as the data saved by get_data(): pages of at most 10,000 patents,
+format {page : {'patents' : [...], 'count' : ..., 'total_patent_count' : ...}}, with the same fields in each patent record.
+Some values are missing or invalid as in the PatentsView data, so that every branch of the preprocessing is exercised.
+"""
+
+# version of the format of the synthetic records, in the name of the generated files, so that older files are generated again
+SYNTHETIC_VERSION = 2
+
+PATENT_TYPES = ['utility'] * 8 + ['design', 'plant', 'reissue', None]
+ASSIGNEE_TYPES = ['2', '3', '4', '5', '6', '7', None]
+
+
+def make_patent(generator, number, num_patents, year = 2015):
+    """
+    Returns a synthetic patent record, with the fields fetched by the year queries (see pipeline.query_parts)
+
+    Inputs
+    :generator: random.Random instance
+    :number: int, patent number
+    :num_patents: int, total number of patents, which sets the number of distinct assignees, locations and cited patents
+    :year: int, year of the application date
+
+    Outputs
+    :patent: dictionary, in the format of the patent records of the PatentsView API
+    """
+    # a few assignees and locations are much more frequent than the others, as in the real data
+    num_assignees = max(num_patents // 10, 10)
+    num_locations = max(num_patents // 20, 10)
+
+    assignees = []
+    for i in range(generator.choice([0, 1, 1, 1, 2])):
+        key = int(num_assignees * generator.random()**3)
+        assignees.append({'assignee_key_id' : generator.choice(['a' + str(key)] * 20 + [None]),
+                          'assignee_organization' : 'Organization ' + str(key),
+                          'assignee_type' : ASSIGNEE_TYPES[key % len(ASSIGNEE_TYPES)]})
+
+    inventors = []
+    for i in range(generator.choice([1, 1, 2, 3, 4])):
+        location = int(num_locations * generator.random()**2)
+        latitude = generator.choice([str(round(-50 + (location * 7919 % 12000) / 100, 2))] * 30 + ['0.1', None])
+        inventors.append({'inventor_key_id' : 'i' + str(generator.randrange(num_patents * 2)),
+                          'inventor_latitude' : latitude,
+                          'inventor_longitude' : None if latitude == None else str(round(-170 + (location * 104729 % 34000) / 100, 2))})
+
+    cited_patents = [{'cited_patent_number' : generator.choice([str(generator.randrange(num_patents * 5))] * 10 + [None])}
+                     for i in range(generator.choice([0, 1, 3, 5, 10]))]
+
+    app_date = datetime.date(year, 1, 1) + datetime.timedelta(days = generator.randrange(365))
+
+    return {'patent_number' : str(number),
+            'patent_type' : generator.choice(PATENT_TYPES),
+            'applications' : [{'app_date' : app_date.isoformat()}],
+            'assignees' : assignees,
+            'inventors' : inventors,
+            'cited_patents' : cited_patents}
+
+
+def write_synthetic_data(file_, num_patents, seed = 0, per_page = 10000, year = 2015):
+    """
+    Writes a synthetic raw data file, one page at a time, so that files of any size can be generated
+
+    Inputs
+    :file_: string type, path of the file
+    :num_patents: int, number of patents
+    :seed: int, seed of the random generator, the same seed always gives the same file
+    :per_page: int, number of patents per page
+    :year: int, year of the application dates
+
+    Outputs
+    :file_: string type, path of the saved file
+    """
+    generator = random.Random(seed)
+
+    with open(file_ + '.tmp', 'w', encoding = 'utf-8') as f:
+        f.write('{')
+        for page, start in enumerate(range(0, num_patents, per_page)):
+            patents = [make_patent(generator, number, num_patents, year) for number in range(start, min(start + per_page, num_patents))]
+            data = {'patents' : patents, 'count' : len(patents), 'total_patent_count' : num_patents}
+            f.write((', ' if page > 0 else '') + json.dumps(str(page + 1)) + ': ' + json.dumps(data))
+        f.write('}')
+    os.replace(file_ + '.tmp', file_)
+
+    return file_
+
+
+def make_networks(num_patents, num_networks = 2, layers = 3, seed = 0):
+    """
+    Returns synthetic patent networks, which cite overlapping ranges of patents
+
+    Inputs
+    :num_patents: int, number of citations in each layer of each network
+    :num_networks: int, number of networks
+    :layers: int, number of layers of each network
+    :seed: int, seed of the random generator
+
+    Outputs
+    :networks: dictionary, format {name : network}, networks in the format of load_layers_data (only the cited patents)
+    """
+    generator = np.random.default_rng(seed)
+    networks = {}
+    for i in range(num_networks):
+        start = i * num_patents
+        networks['network' + str(i)] = {str(layer) : {'cited_patents' : generator.integers(start, start + 4 * num_patents, num_patents).astype(str).tolist()}
+                                        for layer in range(layers)}
+    return networks
+
+
+"""
+FUNCTIONS TO RUN THE BENCHMARKS
+"""
+
+def measure(function, repeat = 1, memory = True):
+    """
+    Measures the running time and the peak memory of a function.
+    The time is measured without tracemalloc, which slows down the allocations, and the memory in an extra run.
+
+    Inputs
+    :function: function without arguments
+    :repeat: int, number of timed runs, the fastest one is kept
+    :memory: if True, the peak memory is measured with tracemalloc
+
+    Outputs
+    :result: return value of the function
+    :seconds: float, running time of the fastest run
+    :peak_mb: float, peak memory allocated during the run in MB, None if memory is False
+    """
+    seconds = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        seconds = elapsed if (seconds == None) else min(seconds, elapsed)
+
+    peak_mb = None
+    if (memory):
+        tracemalloc.start()
+        function()
+        peak_mb = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+
+    return result, seconds, peak_mb
+
+
+def checksum(value):
+    """
+    Returns a short digest of a json serializable summary of a result, to check that the results do not change
+
+    Inputs
+    :value: json serializable value
+
+    Outputs
+    :digest: string type
+    """
+    return hashlib.sha256(json.dumps(value, sort_keys = True, default = str).encode('utf-8')).hexdigest()[:16]
+
+
+def run_benchmarks(num_patents, data_dir, repeat = 1, memory = True, stages = None):
+    """
+    Runs the benchmark of each stage on a synthetic year of data, generated in data_dir if it is not already there
+
+    Inputs
+    :num_patents: int, number of patents of the synthetic data
+    :data_dir: string type, directory of the synthetic data files
+    :repeat: int, number of timed runs of each stage (see measure)
+    :memory: if True, the peak memory of each stage is measured as well (see measure)
+    :stages: (optional) list of the names of the stages to run, all stages by default
+
+    Outputs
+    :results: dictionary, format {stage : {'seconds', 'peak_mb', 'checksum'}}
+    """
+    os.makedirs(data_dir, exist_ok = True)
+    file_ = os.path.join(data_dir, 'synthetic_' + str(num_patents) + '_v' + str(SYNTHETIC_VERSION) + '.json')
+    if not os.path.isfile(file_):
+        print('generating', file_)
+        write_synthetic_data(file_, num_patents)
+
+    def normalize():
+        # remove the cached tables so that they are computed again
+        if os.path.isfile(cache_file(file_)):
+            os.remove(cache_file(file_))
+        load_tables(file_).close()
+        return os.path.getsize(cache_file(file_))
+
+    output = {}
+    networks = make_networks(num_patents)
+
+    benchmarks = {'preprocess_data' : lambda : preprocess_data([file_]),
+                  'normalize' : normalize,
+                  'preprocess_data_vectorized' : lambda : preprocess_data([file_], backend = 'vectorized'),
+                  'preprocess_layer_data' : lambda : preprocess_layer_data(file_),
+                  'get_top_k_locations' : lambda : [get_top_k_locations(output['data']['assignees'], k, output['data']) for k in [10, 100, 1000]],
+                  'get_assignee_ts' : lambda : get_assignee_ts(output['years'], output['organizations'], get_assignee_table(output['years'])),
+                  'compute_similarities' : lambda : compare_networks(networks['network0'], networks['network1']),
+                  'minhash_error' : lambda : minhash_error(networks, '2')}
+
+    # small summary of the result of each stage, to compare with the baseline
+    summaries = {'preprocess_data' : lambda result : [int(result['num_patents']), result['num_citations'], result['num_inventors'],
+                                                      list(result['discarded']), int(result['assignees']['patents'].sum())],
+                 'normalize' : lambda result : None,
+                 'preprocess_layer_data' : lambda result : [len(result[0]), len(result[1])],
+                 'get_top_k_locations' : lambda result : [[len(locations), num_inventors] for locations, top, num_inventors in result],
+                 'get_assignee_ts' : lambda result : result.values.tolist(),
+                 'compute_similarities' : lambda result : result.round(12).values.tolist(),
+                 'minhash_error' : lambda result : bool(result[0].max().max() <= result[1])}
+    summaries['preprocess_data_vectorized'] = summaries['preprocess_data']
+
+    results = {}
+    for stage in benchmarks:
+        if (stages) and (stage not in stages) and (stage != 'preprocess_data'):
+            continue
+        print('running', stage, 'on', num_patents, 'patents')
+        result, seconds, peak_mb = measure(benchmarks[stage], repeat, memory)
+        results[stage] = {'seconds' : seconds, 'peak_mb' : peak_mb, 'checksum' : checksum(summaries[stage](result))}
+
+        if (stage == 'preprocess_data'):
+            # the following stages run on the preprocessed data, as three identical years
+            output['data'] = result
+            output['years'] = {str(year) : result for year in range(2000, 2003)}
+            output['organizations'] = result['assignees']['organization'].dropna().unique()[:100].tolist()
+
+    if (stages) and ('preprocess_data' not in stages):
+        del results['preprocess_data']
+
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance = 0.2):
+    """
+    Compares benchmark results to a baseline
+
+    Inputs
+    :results: dictionary, format {num_patents : results of run_benchmarks}
+    :baseline: same format as results, with the keys as strings, as saved to json
+    :tolerance: float, relative slow down of a stage over the baseline reported as a regression
+
+    Outputs
+    :regressions: list of strings, describing each stage which is slower than the baseline, or whose result changed
+    """
+    regressions = []
+    for size in results:
+        for stage in results[size]:
+            if (stage not in baseline.get(str(size), {})):
+                continue
+            old = baseline[str(size)][stage]
+            new = results[size][stage]
+            if (new['seconds'] > old['seconds'] * (1 + tolerance)):
+                regressions.append('{} on {} patents: {:.3f}s, baseline {:.3f}s'.format(stage, size, new['seconds'], old['seconds']))
+            if (new['checksum'] != old['checksum']):
+                regressions.append('{} on {} patents: result changed'.format(stage, size))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmarks the pipeline stages on synthetic PatentsView data')
+    parser.add_argument('--sizes', type = int, nargs = '+', default = [10000, 100000], help = 'numbers of patents of the synthetic data, from 10k to 10M')
+    parser.add_argument('--data-dir', default = 'benchmark_data', help = 'directory of the synthetic data files')
+    parser.add_argument('--stages', nargs = '+', help = 'stages to run, all stages by default')
+    parser.add_argument('--repeat', type = int, default = 1, help = 'number of timed runs of each stage')
+    parser.add_argument('--no-memory', action = 'store_true', help = 'do not measure the peak memory')
+    parser.add_argument('--baseline', help = 'json file of the baseline results to compare to')
+    parser.add_argument('--save-baseline', action = 'store_true', help = 'save the results as the new baseline')
+    parser.add_argument('--tolerance', type = float, default = 0.2, help = 'relative slow down reported as a regression')
+    parser.add_argument('--output', help = 'json file to save the results to')
+    args = parser.parse_args()
+
+    results = {size : run_benchmarks(size, args.data_dir, args.repeat, not args.no_memory, args.stages) for size in args.sizes}
+
+    for size in results:
+        for stage in results[size]:
+            result = results[size][stage]
+            peak = '' if result['peak_mb'] == None else '{:10.1f} MB'.format(result['peak_mb'])
+            print('{:>10} {:28} {:10.3f} s {}'.format(size, stage, result['seconds'], peak))
+
+    if (args.output):
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent = 2)
+
+    if (args.baseline) and (args.save_baseline):
+        baseline = {}
+        if os.path.isfile(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update({str(size) : results[size] for size in results})
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent = 2)
+        print('baseline saved to', args.baseline)
+
+    elif (args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('regression:', regression)
+        if (regressions):
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
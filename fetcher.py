@@ -0,0 +1,452 @@
+""" data fetching functions """
+
+import asyncio
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+import zlib
+import requests
+from requests.adapters import HTTPAdapter
+from storage import walk_patents, write_patents
+import metrics
+
+"""
+FUNCTIONS TO FETCH DATA FROM THE PATENTSVIEW API
+"""
+
+# url of the query endpoint, which can be set to a local stand-in of the API (see standin_server.py)
+API_URL = os.environ.get('PATENTSVIEW_API_URL', 'http://www.patentsview.org/api/patents/query')
+
+# the PatentsView API allows 45 requests per minute
+REQUESTS_PER_MINUTE = 45
+
+# maximum number of results per page
+PER_PAGE = 10000
+
+# the number of results of a query seems to be capped at 100,000, or 10 pages
+MAX_RESULTS = 100000
+
+# status codes after which a request is retried
+RETRY_STATUS = [429, 500, 502, 503, 504]
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter, shared by all the threads fetching data.
+    Tokens are added at a constant rate up to the capacity of the bucket, and each request takes one token.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def try_acquire(self):
+        """
+        Takes a token if there is one, without waiting. Returns 0 if a token was taken, otherwise the time to wait for the next one
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if (self.tokens >= 1):
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            wait = self.try_acquire()
+            if (wait == 0):
+                return
+            time.sleep(wait)
+
+
+limiter = TokenBucket(REQUESTS_PER_MINUTE / 60, capacity = 5)
+sessions = threading.local()
+
+# response cache, disabled until set_response_cache() is called
+response_cache = {'file' : None, 'max_bytes' : None}
+connections = threading.local()
+
+
+def get_session(pool_size = 10):
+    """
+    Returns the requests session of the current thread, created on first use, so that connections are reused between requests
+
+    Inputs
+    :pool_size: int, maximum number of connections kept open by the session
+
+    Outputs
+    :session: requests.Session
+    """
+    if not hasattr(sessions, 'session'):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections = pool_size, pool_maxsize = pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        sessions.session = session
+
+    return sessions.session
+
+
+def backoff_delay(attempt, response = None, base = 1, cap = 60):
+    """
+    Returns the time to wait before retrying a request: the Retry-After header when the API sends one,
+    otherwise an exponential backoff with random jitter
+
+    Inputs
+    :attempt: int, number of attempts made so far
+    :response: (optional) response of the failed attempt
+    :base: float, delay in seconds after the first attempt
+    :cap: float, maximum delay in seconds
+
+    Outputs
+    :delay: float, in seconds
+    """
+    if (response != None) and (response.headers.get('Retry-After', '').isdigit()):
+        return min(cap, float(response.headers['Retry-After']))
+
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def set_response_cache(file_, max_bytes = 2 * 1024**3):
+    """
+    Enables (or disables) the local cache of the responses of the PatentsView API, consulted before every request.
+    Responses are stored compressed in a SQLite database, and the least recently used ones are evicted
+    when the total size of the stored responses goes over max_bytes.
+    
+    Inputs
+    :file_: string type, path to the SQLite database, created if needed. None disables the cache
+    :max_bytes: int, maximum total size of the compressed responses
+    """
+    response_cache['file'] = file_
+    response_cache['max_bytes'] = max_bytes
+    
+    if (file_ != None):
+        db = get_cache_connection()
+        db.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, data BLOB, size INTEGER, last_used REAL)')
+        db.execute('CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)')
+        db.commit()
+
+
+def get_cache_connection():
+    """
+    Returns the connection of the current thread to the response cache database, opened on first use
+    
+    Outputs
+    :db: sqlite3.Connection
+    """
+    if (getattr(connections, 'file', None) != response_cache['file']):
+        connections.db = sqlite3.connect(response_cache['file'], timeout = 60)
+        connections.db.execute('PRAGMA journal_mode=WAL')
+        connections.file = response_cache['file']
+    
+    return connections.db
+
+
+def cache_key(query_str, fields_str, options, page, url):
+    """
+    Returns the key of a response in the cache: a hash of the query filters, output fields, output options (including the page) and url
+    
+    Outputs
+    :key: string type, hexadecimal sha256 digest
+    """
+    request = json.dumps([query_str, fields_str, options(page), url], sort_keys = True)
+    return hashlib.sha256(request.encode('utf-8')).hexdigest()
+
+
+def cache_get(key):
+    """
+    Returns the cached response for the given key, or None if it is not in the cache
+    """
+    db = get_cache_connection()
+    row = db.execute('SELECT data FROM responses WHERE key = ?', (key,)).fetchone()
+    if (row == None):
+        return None
+    
+    db.execute('UPDATE responses SET last_used = ? WHERE key = ?', (time.time(), key))
+    db.commit()
+    return json.loads(zlib.decompress(row[0]))
+
+
+def cache_put(key, data):
+    """
+    Stores a response in the cache, then evicts the least recently used responses until the cache fits in its size limit
+    """
+    db = get_cache_connection()
+    blob = zlib.compress(json.dumps(data).encode('utf-8'))
+    db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)', (key, blob, len(blob), time.time()))
+    
+    total = db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+    for old_key, size in db.execute('SELECT key, size FROM responses ORDER BY last_used').fetchall():
+        if (total <= response_cache['max_bytes']) or (old_key == key):
+            break
+        db.execute('DELETE FROM responses WHERE key = ?', (old_key,))
+        total -= size
+    db.commit()
+
+
+def fetch_page(query_str, fields_str, options, page, url = None, max_retries = 8, use_cache = True):
+    """
+    Fetches a single page of results from the PatentsView API, waiting for the rate limiter before each request,
+    and retrying with a backoff when the API answers 429 or 5xx, or resets the connection.
+    When the response cache is enabled (see set_response_cache), cached responses are returned without any request,
+    unless use_cache is False: the page is then always fetched, and its cached response replaced.
+
+    Inputs
+    :query_str: query filters, as returned by pipeline.query()
+    :fields_str: list of output fields, format ['field1', 'field2', ...]
+    :options: function, returning the output options of the given page
+    :page: int, page number
+    :url: (optional) string type, url of the API query endpoint (by default: API_URL)
+    :max_retries: int, number of times a request is retried before giving up
+    :use_cache: if False, the cached response is not used, e.g. to get the latest data of a query which was already fetched
+
+    Outputs
+    :data: dictionary, json data returned by the API
+    """
+    if (url == None):
+        url = API_URL
+    
+    if (response_cache['file'] != None):
+        key = cache_key(query_str, fields_str, options, page, url)
+        data = cache_get(key) if (use_cache) else None
+        if (data != None):
+            metrics.count('cache_hits')
+            return data
+    
+    session = get_session()
+
+    # API documentation states that a query longer than 2000 characters can use post method
+    if (len(json.dumps(query_str)) > 1800):
+        # POST METHOD
+        payload = json.dumps({'q': query_str, 'f': fields_str, 'o': options(page)})
+        fetch = lambda : session.post(url, data = payload)
+    else:
+        # GET METHOD
+        params = {'q': json.dumps(query_str), 'f': json.dumps(fields_str), 'o': json.dumps(options(page))}
+        fetch = lambda : session.get(url, params = params)
+
+    for attempt in range(max_retries + 1):
+        with metrics.timer('rate_limit_wait'):
+            limiter.acquire()
+        try:
+            with metrics.timer('http_request'):
+                r = fetch()
+        except requests.ConnectionError as error:
+            if (attempt == max_retries):
+                raise
+            print('connection error, retrying :', error)
+            metrics.count('http_retries')
+            time.sleep(backoff_delay(attempt))
+            continue
+        
+        metrics.count('http_requests')
+        metrics.count('bytes_downloaded', len(r.content))
+
+        if (r.status_code in RETRY_STATUS) and (attempt < max_retries):
+            print('Error exit code :', r.status_code, ', retrying')
+            metrics.count('http_retries')
+            time.sleep(backoff_delay(attempt, r))
+            continue
+
+        if (r.status_code != 200):
+            print('Error exit code :', r.status_code)
+            print(r.headers)
+            r.raise_for_status()
+
+        with metrics.timer('json_decode'):
+            data = r.json()
+        if (response_cache['file'] != None):
+            cache_put(key, data)
+        
+        return data
+
+
+def iter_query_pages(query_str, fields_str, options, url = None, start_page = 1, use_cache = True):
+    """
+    Fetches the pages of results of a query from the PatentsView API one at a time
+    
+    Inputs
+    :query_str: query filters, as returned by pipeline.query()
+    :fields_str: list of output fields, format ['field1', 'field2', ...]
+    :options: function, returning the output options of the given page
+    :url: (optional) string type, url of the API query endpoint (by default: API_URL)
+    :start_page: int, first page to fetch
+    :use_cache: if False, the response cache is bypassed (see fetch_page)
+    
+    Outputs
+    :pages: generator of (page, data), with the json data of each page
+    """
+    page = start_page
+    
+    print('fetching page', page)
+    data = fetch_page(query_str, fields_str, options, page, url, use_cache = use_cache)
+    yield page, data
+    
+    # continue until there are less than 10,000 results in the new page, which indicates the end of the results
+    while (data['count'] == PER_PAGE):
+        page += 1
+        print('fetching page', page)
+        # the documentation states that there is no hard limit on the queries, but through our experimentation,
+        # the number of results often seems to be capped at 100,000.
+        if (page == 11):
+            print('page limit reached, double check data')
+        data = fetch_page(query_str, fields_str, options, page, url, use_cache = use_cache)
+        yield page, data
+
+
+def fetch_query(query_str, fields_str, options, url = None, use_cache = True):
+    """
+    Fetches all the pages of results of a query from the PatentsView API
+    
+    Inputs
+    :query_str: query filters, as returned by pipeline.query()
+    :fields_str: list of output fields, format ['field1', 'field2', ...]
+    :options: function, returning the output options of the given page
+    :url: (optional) string type, url of the API query endpoint (by default: API_URL)
+    :use_cache: if False, the response cache is bypassed (see fetch_page)
+    
+    Outputs
+    :data_list: dictionary of the json data of each page, format {page : data}
+    """
+    return dict(iter_query_pages(query_str, fields_str, options, url, use_cache = use_cache))
+
+
+def count_results(query_str, url = None):
+    """
+    Returns the total number of results of a query, fetching a single result
+    
+    Inputs
+    :query_str: query filters, as returned by pipeline.query()
+    :url: (optional) string type, url of the API query endpoint (by default: API_URL)
+    
+    Outputs
+    :count: int, total number of patents matching the query
+    """
+    data = fetch_page(query_str, ['patent_number'], lambda page : {'page': page, 'per_page': 1}, 1, url)
+    return data['total_patent_count']
+
+
+def read_journal(journal_, query_hash):
+    """
+    Reads the pages already saved in the journal of a download, and truncates the journal after its last complete page.
+    The journal starts with a line '#<query hash>', then holds one page per line, format '<page>\t<count>\t<json data>'.
+    A journal which is missing, or written for another query, is started again with only its header line,
+    so that the pages of the download can always be appended to it.
+    
+    Inputs
+    :journal_: string type, path to the journal
+    :query_hash: string type, hash of the query being downloaded. A journal written for another query is discarded
+    
+    Outputs
+    :last_page: int, last complete page in the journal, 0 if there is none
+    :last_count: int, number of results in the last complete page
+    """
+    last_page, last_count = 0, 0
+    header = '#' + query_hash + '\n'
+    
+    if os.path.isfile(journal_):
+        with open(journal_, 'r+', encoding = 'utf-8') as f:
+            if (f.readline() == header):
+                end = f.tell()
+                for line in iter(f.readline, ''):
+                    # a line cut by an interrupted run, or which cannot be parsed, is dropped with all the lines after it
+                    try:
+                        page, count, data = line.split('\t', 2)
+                        page, count = int(page), int(count)
+                    except ValueError:
+                        break
+                    if not (line.endswith('\n')):
+                        break
+                    last_page, last_count = page, count
+                    end = f.tell()
+                f.truncate(end)
+                return last_page, last_count
+    
+    with open(journal_, 'w', encoding = 'utf-8') as f:
+        f.write(header)
+    
+    return last_page, last_count
+
+
+def download_query(query_str, fields_str, options, file_, url = None, use_cache = True):
+    """
+    Fetches all the pages of results of a query from the PatentsView API and saves them to file_, in the format {page : data},
+    or as compressed json lines when file_ ends with '.jsonl.gz' (see storage.write_patents).
+    Each page is appended to an on-disk journal as soon as it arrives, so that a download which was interrupted
+    resumes after its last complete page, and only one page is held in memory at a time.
+    
+    Inputs
+    :query_str: query filters, as returned by pipeline.query()
+    :fields_str: list of output fields, format ['field1', 'field2', ...]
+    :options: function, returning the output options of the given page
+    :file_: string type, path of the file to save the data to
+    :url: (optional) string type, url of the API query endpoint (by default: API_URL)
+    :use_cache: if False, the response cache is bypassed (see fetch_page)
+    
+    Outputs
+    :file_: string type, path of the saved data
+    """
+    journal_ = file_ + '.journal'
+    query_hash = hashlib.sha256(json.dumps([query_str, fields_str, options(1), url], sort_keys = True).encode('utf-8')).hexdigest()
+    last_page, last_count = read_journal(journal_, query_hash)
+    
+    if (last_page == 0) or (last_count == PER_PAGE):
+        if (last_page > 0):
+            print('resuming download after page', last_page)
+        with open(journal_, 'a', encoding = 'utf-8') as f:
+            for page, data in iter_query_pages(query_str, fields_str, options, url, last_page + 1, use_cache):
+                f.write(str(page) + '\t' + str(data['count']) + '\t' + json.dumps(data) + '\n')
+                f.flush()
+    
+    # copy the journal to file_, one page at a time
+    print('saving data')
+    with open(journal_, encoding = 'utf-8') as journal:
+        journal.readline()
+        
+        if (file_.endswith('.jsonl.gz')):
+            pages = (json.loads(line.split('\t', 2)[2]) for line in journal)
+            write_patents((patent for data in pages for patent in walk_patents(data)), file_)
+        
+        else:
+            with open(file_ + '.tmp', 'w', encoding = 'utf-8') as f:
+                f.write('{')
+                for i, line in enumerate(journal):
+                    page, count, data = line.split('\t', 2)
+                    f.write((', ' if i > 0 else '') + json.dumps(page) + ': ' + data.rstrip('\n'))
+                f.write('}')
+            os.replace(file_ + '.tmp', file_)
+    
+    os.remove(journal_)
+    
+    return file_
+
+
+async def fetch_queries_async(queries, concurrency, url = None):
+    """
+    Fetches several queries from the PatentsView API concurrently, with at most concurrency queries in flight at a time.
+    Each query runs fetch_query() in a worker thread, so all requests still share the same rate limit.
+
+    Inputs
+    :queries: list of (query_str, fields_str, options), as passed into fetch_query()
+    :concurrency: int, maximum number of queries fetched at the same time
+    :url: (optional) string type, url of the API query endpoint (by default: API_URL)
+
+    Outputs
+    :results: list of the data returned by fetch_query() for each query, in the order of the queries
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch(parts):
+        async with semaphore:
+            return await asyncio.to_thread(fetch_query, *parts, url)
+
+    return await asyncio.gather(*[fetch(parts) for parts in queries])
@@ -0,0 +1,270 @@
+""" citation graph functions """
+
+import os
+import numpy as np
+
+"""
+FUNCTIONS TO BUILD THE CITATION GRAPH
+
+The graph maps each patent number to an integer id, and stores the citations in compressed sparse row (CSR) arrays:
+the patents cited by the patent with id i are indices[indptr[i]:indptr[i+1]].
+A patent is 'expanded' when its own record has been added to the graph, i.e. when its citations are known,
+otherwise it only appears in the graph as a cited patent.
+"""
+
+GRAPH_ARRAYS = ['ids', 'indptr', 'indices', 'expanded']
+
+
+def empty_graph():
+    """
+    Returns a graph without any patent
+
+    Outputs
+    :graph: dictionary, format {'ids', 'indptr', 'indices', 'expanded', 'index'}
+    """
+    return make_graph([], np.array([], dtype = np.int64), np.array([], dtype = np.int64), np.array([], dtype = bool))
+
+
+def make_graph(ids, sources, targets, expanded):
+    """
+    Builds the CSR arrays of a graph from its list of edges
+
+    Inputs
+    :ids: list of patent numbers, the id of each patent is its position in the list
+    :sources: numpy int array, id of the citing patent of each edge
+    :targets: numpy int array, id of the cited patent of each edge
+    :expanded: numpy bool array, whether the citations of each patent are known
+
+    Outputs
+    :graph: dictionary, format {'ids', 'indptr', 'indices', 'expanded', 'index'}
+    """
+    num_patents = len(ids)
+
+    # each citation is only counted once, and edges are sorted by citing patent then cited patent
+    edges = np.unique(np.stack([sources, targets], axis = 1).reshape(-1, 2), axis = 0)
+    indptr = np.zeros(num_patents + 1, dtype = np.int64)
+    indptr[1:] = np.cumsum(np.bincount(edges[:,0], minlength = num_patents))
+
+    graph = {'ids' : np.array(ids, dtype = str),
+             'indptr' : indptr,
+             'indices' : edges[:,1].astype(np.int64),
+             'expanded' : np.asarray(expanded, dtype = bool),
+             'index' : {number : i for i, number in enumerate(ids)}}
+
+    return graph
+
+
+def update_graph(graph, records):
+    """
+    Adds patent records to a graph. The citations of patents which are already expanded are replaced by those of the new records.
+    Records without a patent number are skipped, and reissue patents are expanded without any citation, as they are left out of the layers.
+
+    Inputs
+    :graph: as returned by empty_graph(), load_graph() or update_graph()
+    :records: iterable of patent records including the 'patent_number' field, as returned by storage.iter_patents()
+
+    Outputs
+    :graph: new graph, including the records
+    """
+    ids = graph['ids'].tolist()
+    index = dict(graph['index'])
+
+    def get_id(number):
+        if number not in index:
+            index[number] = len(ids)
+            ids.append(number)
+        return index[number]
+
+    sources = []
+    targets = []
+    updated = set()
+
+    for patent in records:
+        if (patent == None) or not (patent.get('patent_number')):
+            continue
+        source = get_id(patent['patent_number'])
+        updated.add(source)
+        # as in pipeline.preprocess_layer_data(), the citations of reissue patents are not followed
+        if (patent.get('patent_type') == 'reissue'):
+            continue
+        for cit_patent in patent['cited_patents']:
+            if (cit_patent['cited_patent_number']):
+                sources.append(source)
+                targets.append(get_id(cit_patent['cited_patent_number']))
+
+    # keep the edges of the patents which were not updated
+    old_sources = np.repeat(np.arange(len(graph['ids'])), np.diff(graph['indptr']))
+    keep = ~np.isin(old_sources, list(updated))
+
+    expanded = np.zeros(len(ids), dtype = bool)
+    expanded[:len(graph['ids'])] = graph['expanded']
+    expanded[list(updated)] = True
+
+    return make_graph(ids,
+                      np.concatenate([old_sources[keep], np.array(sources, dtype = np.int64)]),
+                      np.concatenate([np.asarray(graph['indices'])[keep], np.array(targets, dtype = np.int64)]),
+                      expanded)
+
+
+def save_graph(graph, path):
+    """
+    Saves a graph to a directory, with one .npy file per array
+
+    Inputs
+    :graph: as returned by update_graph()
+    :path: string type, directory to save the graph to, created if needed
+    """
+    os.makedirs(path, exist_ok = True)
+    for name in GRAPH_ARRAYS:
+        with open(os.path.join(path, name + '.npy.tmp'), 'wb') as f:
+            np.save(f, graph[name])
+    # replace the arrays only once they are all written
+    for name in GRAPH_ARRAYS:
+        os.replace(os.path.join(path, name + '.npy.tmp'), os.path.join(path, name + '.npy'))
+
+
+def load_graph(path, mmap = True):
+    """
+    Loads a graph saved by save_graph(), or returns an empty graph if there is none
+
+    Inputs
+    :path: string type, directory of the saved graph
+    :mmap: if True, the arrays are memory-mapped from disk instead of being read in memory
+
+    Outputs
+    :graph: dictionary, format {'ids', 'indptr', 'indices', 'expanded', 'index'}
+    """
+    if not os.path.isfile(os.path.join(path, 'indptr.npy')):
+        return empty_graph()
+
+    graph = {name : np.load(os.path.join(path, name + '.npy'), mmap_mode = 'r' if mmap else None) for name in GRAPH_ARRAYS}
+    graph['index'] = {number : i for i, number in enumerate(graph['ids'].tolist())}
+
+    return graph
+
+
+"""
+FUNCTIONS TO QUERY THE CITATION GRAPH
+"""
+
+def get_ids(graph, patent_numbers):
+    """
+    Returns the ids of the given patent numbers, skipping the patent numbers which are not in the graph
+
+    Inputs
+    :graph: as returned by load_graph() or update_graph()
+    :patent_numbers: list of patent numbers
+
+    Outputs
+    :ids: numpy int array
+    """
+    return np.array([graph['index'][number] for number in patent_numbers if number in graph['index']], dtype = np.int64)
+
+
+def cited_ids(graph, ids):
+    """
+    Returns the ids of all the patents cited by the given patents, with repetitions
+
+    Inputs
+    :graph: as returned by load_graph() or update_graph()
+    :ids: numpy int array
+
+    Outputs
+    :cited: numpy int array
+    """
+    starts = graph['indptr'][ids]
+    counts = graph['indptr'][ids + 1] - starts
+
+    # positions of the cited patents of each patent in the indices array, without looping over the patents
+    offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+
+    return np.asarray(graph['indices'])[offsets + np.arange(counts.sum())]
+
+
+def out_degree(graph, patent_numbers):
+    """
+    Returns the number of patents cited by each of the given patents, 0 for patents not in the graph
+
+    Inputs
+    :graph: as returned by load_graph() or update_graph()
+    :patent_numbers: list of patent numbers
+
+    Outputs
+    :degrees: numpy int array
+    """
+    degrees = np.diff(graph['indptr'])
+    return np.array([degrees[graph['index'][number]] if number in graph['index'] else 0 for number in patent_numbers])
+
+
+def in_degree(graph, patent_numbers):
+    """
+    Returns the number of patents citing each of the given patents, among the expanded patents of the graph
+
+    Inputs
+    :graph: as returned by load_graph() or update_graph()
+    :patent_numbers: list of patent numbers
+
+    Outputs
+    :degrees: numpy int array
+    """
+    if ('in_degree' not in graph):
+        graph['in_degree'] = np.bincount(graph['indices'], minlength = len(graph['ids']))
+    degrees = graph['in_degree']
+
+    return np.array([degrees[graph['index'][number]] if number in graph['index'] else 0 for number in patent_numbers])
+
+
+def bfs(graph, patent_numbers, depth):
+    """
+    Breadth-first search from the given root patents, following citations up to the given depth.
+    Each patent only appears in the layer where it is first reached.
+
+    Inputs
+    :graph: as returned by load_graph() or update_graph()
+    :patent_numbers: list of root patent numbers
+    :depth: int, number of citation steps to follow
+
+    Outputs
+    :layers: list of depth + 1 lists of patent numbers, the first one being the roots found in the graph
+    """
+    visited = np.zeros(len(graph['ids']), dtype = bool)
+    frontier = np.unique(get_ids(graph, patent_numbers))
+    visited[frontier] = True
+    layers = [frontier]
+
+    for i in range(depth):
+        frontier = np.unique(cited_ids(graph, frontier))
+        frontier = frontier[~visited[frontier]]
+        visited[frontier] = True
+        layers.append(frontier)
+
+    return [graph['ids'][layer].tolist() for layer in layers]
+
+
+def get_layers(graph, patent_numbers, layers):
+    """
+    Returns the patents in each layer of the network supporting the given patents, as in pipeline.get_layers_data():
+    layer i+1 holds all the patents cited by the patents of layer i, even if they already appear in a previous layer.
+    As in get_layers_data(), the citations of reissue patents are not followed (see update_graph).
+    Empty cited patent numbers, which get_layers_data() keeps but which match no patent, are not in the graph.
+
+    Inputs
+    :graph: as returned by load_graph() or update_graph()
+    :patent_numbers: list of root patent numbers
+    :layers: int, number of layers
+
+    Outputs
+    :network: list of layers lists of unique patent numbers
+    :missing: list of the patent numbers of the network which are not expanded in the graph, i.e. whose citations are not known
+    """
+    frontier = np.unique(get_ids(graph, patent_numbers))
+    network = []
+    missing = set(number for number in patent_numbers if number not in graph['index'])
+
+    for i in range(layers):
+        network.append(graph['ids'][frontier].tolist())
+        missing.update(graph['ids'][frontier[~np.asarray(graph['expanded'])[frontier]]].tolist())
+        if (i < layers - 1):
+            frontier = np.unique(cited_ids(graph, frontier))
+
+    return network, sorted(missing)
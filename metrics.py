@@ -0,0 +1,228 @@
+""" pipeline instrumentation functions """
+
+import collections
+import contextlib
+import cProfile
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # not available on windows, the memory is then not sampled
+    resource = None
+
+"""
+FUNCTIONS TO RECORD METRICS
+
+Metrics are recorded in memory, for the whole process:
+- timers: number of calls and total time of each stage, e.g. 'get_data' or 'preprocess_data'
+- counters: e.g. 'records', 'http_retries', 'bytes_read'
+- memory: peak memory allocated during each stage, above the memory in use at its start, in bytes,
+  only when the allocations are traced with tracemalloc (see configure)
+Stages can be nested, e.g. 'preprocess_data' includes 'aggregate' and 'format_aggregates'.
+The highest resident memory of the whole process is reported apart, as 'max_rss' (see snapshot).
+"""
+
+lock = threading.Lock()
+timers = collections.defaultdict(lambda : {'calls' : 0, 'seconds' : 0.0})
+counters = collections.Counter()
+memory = {}
+# [memory at the start, peak so far] of the stages currently running, in all threads
+open_stages = []
+# directory to save the cProfile statistics of the outermost stages to, None to disable profiling,
+# and whether the peak memory of the stages is traced (see configure)
+settings = {'profile_dir' : None, 'profiling' : False, 'trace_memory' : False}
+
+
+def configure(profile_dir = None, trace_memory = False):
+    """
+    Configures the instrumentation
+
+    Inputs
+    :profile_dir: (optional) string type, if given, each outermost stage is profiled with cProfile,
+                  and its statistics are saved to profile_dir/<stage>.prof, to be read with pstats
+    :trace_memory: (optional) if True, the allocations are traced with tracemalloc, which slows them down,
+                   and the peak memory of each stage is recorded
+    """
+    settings['profile_dir'] = profile_dir
+    if (profile_dir):
+        os.makedirs(profile_dir, exist_ok = True)
+    settings['trace_memory'] = trace_memory
+    if (trace_memory) and not (tracemalloc.is_tracing()):
+        tracemalloc.start()
+
+
+def reset():
+    """
+    Clears all the metrics recorded so far
+    """
+    with lock:
+        timers.clear()
+        counters.clear()
+        memory.clear()
+
+
+def count(name, value = 1):
+    """
+    Adds to a counter
+
+    Inputs
+    :name: string type, name of the counter
+    :value: int, value to add
+    """
+    with lock:
+        counters[name] += value
+
+
+def max_rss():
+    """
+    Returns the highest resident memory of the process so far
+
+    Outputs
+    :bytes: int, None if it cannot be measured on this platform
+    """
+    if (resource == None):
+        return None
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@contextlib.contextmanager
+def timer(stage):
+    """
+    Context manager recording the time spent in a stage, and its peak memory when the allocations are traced
+
+    The peak of tracemalloc is reset at the start of each stage, after it has been kept by the stages
+    already running, so that nested stages (and stages of other threads) each get their own peak.
+
+    Inputs
+    :stage: string type, name of the stage
+    """
+    profiler = None
+    entry = None
+    with lock:
+        if (settings['profile_dir']) and not (settings['profiling']):
+            settings['profiling'] = True
+            profiler = cProfile.Profile()
+        if (settings['trace_memory']) and (tracemalloc.is_tracing()):
+            current, peak = tracemalloc.get_traced_memory()
+            for running in open_stages:
+                running[1] = max(running[1], peak)
+            tracemalloc.reset_peak()
+            entry = [current, current]
+            open_stages.append(entry)
+
+    start = time.perf_counter()
+    if (profiler):
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if (profiler):
+            profiler.disable()
+            profiler.dump_stats(os.path.join(settings['profile_dir'], stage + '.prof'))
+            settings['profiling'] = False
+
+        elapsed = time.perf_counter() - start
+        with lock:
+            timers[stage]['calls'] += 1
+            timers[stage]['seconds'] += elapsed
+            if (entry != None):
+                open_stages.remove(entry)
+                if (tracemalloc.is_tracing()):
+                    entry[1] = max(entry[1], tracemalloc.get_traced_memory()[1])
+                memory[stage] = max(memory.get(stage, 0), entry[1] - entry[0])
+
+
+def timed(stage):
+    """
+    Decorator recording the time spent in each call of a function as a stage (see timer)
+
+    Inputs
+    :stage: string type, name of the stage
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+"""
+FUNCTIONS TO EXPORT METRICS
+"""
+
+def snapshot():
+    """
+    Returns a copy of all the metrics recorded so far
+
+    Outputs
+    :metrics: dictionary, format {'timers' : {stage : {'calls', 'seconds'}}, 'counters' : {name : value},
+              'memory' : {stage : bytes}, 'max_rss' : bytes of the whole process, None if it cannot be measured}
+    """
+    rss = max_rss()
+    with lock:
+        return {'timers' : {stage : dict(timers[stage]) for stage in timers},
+                'counters' : dict(counters),
+                'memory' : dict(memory),
+                'max_rss' : rss}
+
+
+def to_json(file_ = None):
+    """
+    Exports the metrics in json format
+
+    Inputs
+    :file_: (optional) string type, path of the file to save the metrics to
+
+    Outputs
+    :text: string type, metrics in json format
+    """
+    text = json.dumps(snapshot(), indent = 2, sort_keys = True)
+    if (file_):
+        with open(file_, 'w') as f:
+            f.write(text)
+    return text
+
+
+def to_prometheus(prefix = 'patents_pipeline', file_ = None):
+    """
+    Exports the metrics in the Prometheus text format
+
+    Inputs
+    :prefix: string type, prefix of the names of the metrics
+    :file_: (optional) string type, path of the file to save the metrics to, e.g. for the textfile collector of the node exporter
+
+    Outputs
+    :text: string type, metrics in the Prometheus text format
+    """
+    metrics = snapshot()
+    lines = []
+
+    def add(name, kind, samples):
+        lines.append('# TYPE ' + prefix + '_' + name + ' ' + kind)
+        for labels, value in samples:
+            lines.append(prefix + '_' + name + labels + ' ' + repr(float(value)))
+
+    stages = sorted(metrics['timers'])
+    add('stage_calls_total', 'counter', [('{stage="' + stage + '"}', metrics['timers'][stage]['calls']) for stage in stages])
+    add('stage_seconds_total', 'counter', [('{stage="' + stage + '"}', metrics['timers'][stage]['seconds']) for stage in stages])
+    add('stage_peak_memory_bytes', 'gauge', [('{stage="' + stage + '"}', metrics['memory'][stage]) for stage in sorted(metrics['memory'])])
+    if (metrics['max_rss'] != None):
+        add('process_max_rss_bytes', 'gauge', [('', metrics['max_rss'])])
+    for name in sorted(metrics['counters']):
+        add(name + '_total', 'counter', [('', metrics['counters'][name])])
+
+    text = '\n'.join(lines) + '\n'
+    if (file_):
+        with open(file_ + '.tmp', 'w') as f:
+            f.write(text)
+        os.replace(file_ + '.tmp', file_)
+    return text
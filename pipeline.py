@@ -3,11 +3,21 @@
 import pandas as pd
 import numpy as np
 import os
-import requests
+import io
 import json
+import gzip
 import collections
-import time
-from collections import Counter
+import pickle
+import asyncio
+import datetime
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
+from fetcher import fetch_query, fetch_queries_async, download_query, count_results, MAX_RESULTS
+from storage import iter_patents, walk_patents, load_tables, read_column, iter_cached_patents, source_stamp
+from storage import open_raw, strip_extension, find_raw_file, write_patents, RAW_EXTENSIONS
+from graph import load_graph, update_graph, save_graph
+import metrics
 
 """
 FUNCTIONS TO QUERY AND SAVE DATA
@@ -45,17 +55,21 @@ def query(app_date_from, app_date_to, patent_number):
     return query_str
 
 
-def get_data(query_str, fields_str, options, filename, filepath):
+@metrics.timed('get_data')
+def get_data(query_str, fields_str, options, filename, filepath, url = None, use_cache = True):
     """
     Extract and save data from the PatentsView API.
-    Saves each page of data (max 10,000 results) in a dictionary collection, which is then saved to file.
+    Saves each page of data (max 10,000 results) to a journal as it arrives, which is then saved to file as a dictionary collection.
+    If a previous download of the same query was interrupted, resumes it after its last complete page.
     
     Inputs
     :query_str: string type, should be output from query() function
     :fields_str: string type, format ['field1', 'field2', ...]
     :options: string type, options specifying the type of output from PatentsView API
-    :filename: string type, data filename for the fetched data
+    :filename: string type, data filename for the fetched data. Data is saved as compressed json lines if it ends with '.jsonl.gz'
     :filepath: string type, data folder path
+    :url: (optional) string type, url of the API query endpoint (by default: fetcher.API_URL, set by the PATENTSVIEW_API_URL environment variable)
+    :use_cache: if False, the response cache is bypassed, so that data fetched again is up to date (see fetcher.fetch_page)
     
     Outputs
     :file_: string type, complete file path of the saved data
@@ -67,84 +81,34 @@ def get_data(query_str, fields_str, options, filename, filepath):
     else:
         file_ = filename
 
-    page = 1
-    data_list = collections.defaultdict(list)
-
-    # API documentation states that a query longer than 2000 characters can use post method
-    if (len(json.dumps(query_str)) > 1800):
-        # POST METHOD
-        payload = lambda page : {'q': query_str,
-                                 'f': fields_str,
-                                 'o': options(page)}   
-
-        fetch = lambda page : requests.post('http://www.patentsview.org/api/patents/query', data = json.dumps(payload(page)))
-        
-    else:
-        # GET METHOD        
-        query_str = json.dumps(query_str)
-        fields_str = json.dumps(fields_str)        
-        request_str = lambda page : 'http://www.patentsview.org/api/patents/query?q=' + query_str + '&f=' + fields_str + '&o=' + json.dumps(options(page))
-        
-        fetch = lambda page : requests.get(request_str(page))
-    
-    print('fetching first page')
-    r = fetch(page)
-    data_list[page] = r.json()
-
-    # continue until there are less than 10,000 results in the new page, which indicates the end of the results
-    while (r.json()['count'] == 10000):
-
-        if (r.status_code == 200): 
-            page += 1
-            print('fetching page', page)
-            # the documentation states that there is no hard limit on the queries, but through our experimentation,
-            # the number of results often seems to be capped at 100,000.
-            if (page == 11):
-                print('page limit reached, double check data')
-            # this proved to be enough time between requests in order to not get a 104 (connection reset by peer) error
-            time.sleep(60)
-            
-            r = fetch(page)
-            data_list[page] = r.json()
-        else:
-            print('Error exit code :',r.status_code)
-            print(r.headers())
-    
-    if (r.status_code != 200):
-        print('Error exit code :',r.status_code)
-        print(r.headers())
-    else:
-        # save data
-        print('saving data')
-        with open(file_, 'w') as f:
-            json.dump(data_list, f)
+    # requests are rate limited and retried on errors by the fetcher (see fetcher.fetch_page), 
+    # and each page is saved as soon as it arrives, so that an interrupted download can be resumed (see fetcher.download_query)
+    download_query(query_str, fields_str, options, file_, url, use_cache)
     
     return file_
 
 
-def patentsviewAPI(filename, filepath = None, app_date_from = None, app_date_to = None, patent_number = None):
+def query_parts(app_date_from = None, app_date_to = None, patent_number = None):
     """
     Build the query string parts (filters, output fields, output options) in the PatentsView API format
     
     Inputs
-    :filename: string type, data filename (without extension) for the fetched data
-    :filepath: string type, data folder path
     :app_date_*: string type, format 'YYYY-MM-DD'
     :patent_number: string type, format ['key1', 'key2', ...] or 'key1'
     
     Outputs
-    :file_: string type, full file path of the saved data
+    :query_str: query filters, as returned by query()
+    :all_fields: list of output fields
+    :options: function, returning the output options of the given page
     """
-    if (filename[-5:] != '.json'):
-        filename = filename + '.json'
-    
     # build query string
     query_str = query(app_date_from, app_date_to, patent_number)
     
     # See Methodology notebook for the choice of output fields
+    # the patent number and application date identify the patents already fetched in incremental updates (see update_year_data)
     if (app_date_from) and (app_date_to):
         all_fields = ['cited_patent_number', 'inventor_latitude', 'inventor_longitude', 'patent_type',
-                      'assignee_organization', 'assignee_type']
+                      'assignee_organization', 'assignee_type', 'patent_number', 'app_date']
     else:
         all_fields = ['cited_patent_number','inventor_latitude','inventor_longitude', 'patent_type']
     
@@ -153,8 +117,33 @@ def patentsviewAPI(filename, filepath = None, app_date_from = None, app_date_to
     # though the maximum number of results per query seems to be set at (100,000) or 10 pages.
     options = lambda page : {'page': page, 'per_page': 10000}
     
+    return query_str, all_fields, options
+
+
+def patentsviewAPI(filename, filepath = None, app_date_from = None, app_date_to = None, patent_number = None, compress = False, url = None, use_cache = True):
+    """
+    Build the query string parts (filters, output fields, output options) in the PatentsView API format,
+    then fetch and save the data
+    
+    Inputs
+    :filename: string type, data filename (without extension) for the fetched data
+    :filepath: string type, data folder path
+    :app_date_*: string type, format 'YYYY-MM-DD'
+    :patent_number: string type, format ['key1', 'key2', ...] or 'key1'
+    :compress: if True, the data is saved as gzip compressed json lines, with one patent per line (see storage.write_patents)
+    :url: (optional) string type, url of the API query endpoint (see get_data)
+    :use_cache: if False, the response cache is bypassed (see get_data)
+    
+    Outputs
+    :file_: string type, full file path of the saved data
+    """
+    if not any(filename.endswith(extension) for extension in RAW_EXTENSIONS):
+        filename = filename + ('.jsonl.gz' if compress else '.json')
+    
+    query_str, all_fields, options = query_parts(app_date_from, app_date_to, patent_number)
+    
     # fetch the data from the PatentsView API
-    file_ = get_data(query_str, all_fields, options, filename, filepath)
+    file_ = get_data(query_str, all_fields, options, filename, filepath, url, use_cache)
 
     return file_
 
@@ -165,12 +154,518 @@ FUNCTIONS TO PRE-PROCESS DATA
 FUNCTIONS FOR PART 1
 """
 
-def preprocess_data(files):
+# version of the layout of the accumulators, to invalidate the accumulators cached by older versions (see preprocess_partial)
+AGGREGATES_VERSION = 2
+
+
+def init_aggregates():
+    """
+    Creates the empty accumulators which are filled one patent at a time by aggregate_patent().
+    Assignees are indexed by their assignee_key_id in a dictionary, so that every lookup is done in constant time.
+    
+    Outputs
+    :agg: dictionary of accumulators, to pass into aggregate_patent() and format_aggregates()
+    """
+    
+    agg = {'patent_type_count' : collections.Counter(),
+           # locations are numbered in order of first appearance, location -> id
+           'location_index' : {},
+           'location_keys' : [],
+           'location_count' : [],
+           'inventor_keys' : set(),
+           'cited_patents' : set(),
+           # assignee_key_id -> row in the assignee_* lists
+           'assignee_index' : {},
+           'assignee_key_id' : [],
+           'assignee_org' : [],
+           'assignee_type' : [],
+           'assignee_cited_patents_count' : [],
+           'assignee_patents_count' : [],
+           # (assignee row, location id) -> number of inventors
+           'assignee_locations' : collections.Counter(),
+           'discarded_patents' : 0,
+           'discarded_citations' : 0,
+           'discarded_assignees' : set(),
+           'discarded_inventors' : set(),
+           # when a patent has no valid inventor (resp. no citation), the assignees are credited with
+           # the values left by the previous patent, so both are kept from one patent to the next.
+           # None until a first value is set, see merge_aggregates()
+           'inventor_location' : None,
+           'cited_patents_count' : None,
+           # row -> number of times the assignee was credited before a first value was set
+           'pending_locations' : collections.Counter(),
+           'pending_citations' : collections.Counter()}
+    
+    return agg
+
+
+def location_id(agg, location):
+    """
+    Returns the id of a location in the accumulators, adding the location if it is new
+    
+    Inputs
+    :agg: accumulators, as returned by init_aggregates()
+    :location: (latitude, longitude)
+    
+    Outputs
+    :id: int, row of the location in the 'locations' output of preprocess_data()
+    """
+    if location not in agg['location_index']:
+        agg['location_index'][location] = len(agg['location_keys'])
+        agg['location_keys'].append(location)
+        agg['location_count'].append(0)
+    return agg['location_index'][location]
+
+
+def aggregate_patent(agg, patent):
+    """
+    Adds a single patent record, as returned by the PatentsView API, to the accumulators. (see Methodology notebook)
+    
+    Inputs
+    :agg: accumulators, as returned by init_aggregates()
+    :patent: dictionary, one element of the 'patents' list of a page of data
+    """
+    
+    patent_type = patent['patent_type']
+    
+    # see Methodology notebook for description of the process
+    if (patent_type == 'reissue') or (patent_type == None) or (patent_type == ''):
+        agg['discarded_patents'] += 1
+        return
+    
+    agg['patent_type_count'][patent_type] += 1
+    assignee_index = agg['assignee_index']
+    add_assignees = []
+    
+    for assignee in patent['assignees']:
+        assignee_id = assignee['assignee_key_id']
+        if (assignee_id) and (assignee['assignee_type']):
+            if assignee_id not in assignee_index:
+                assignee_index[assignee_id] = len(agg['assignee_key_id'])
+                agg['assignee_key_id'].append(assignee_id)
+                agg['assignee_type'].append(assignee['assignee_type'])
+                agg['assignee_org'].append(assignee['assignee_organization'])
+                agg['assignee_cited_patents_count'].append(0)
+                agg['assignee_patents_count'].append(0)
+            row = assignee_index[assignee_id]
+            add_assignees.append(row)
+            agg['assignee_patents_count'][row] += 1
+        else:
+            agg['discarded_assignees'].add(assignee_id)
+    
+    for inventor in patent['inventors']:
+        lat = inventor['inventor_latitude']
+        lon = inventor['inventor_longitude']
+        if (lat != '0.1') and (lat != None) and (inventor['inventor_key_id']):
+            location = location_id(agg, (float(lat), float(lon)))
+            agg['inventor_location'] = location
+            agg['location_count'][location] += 1
+            agg['inventor_keys'].add(inventor['inventor_key_id'])
+        else:
+            agg['discarded_inventors'].add(inventor['inventor_key_id'])
+    
+    for row in add_assignees:
+        if (agg['inventor_location'] == None):
+            agg['pending_locations'][row] += 1
+        else:
+            agg['assignee_locations'][(row, agg['inventor_location'])] += 1
+    
+    for cit_patent in patent['cited_patents']:
+        if (cit_patent['cited_patent_number']):
+            agg['cited_patents'].add(cit_patent['cited_patent_number'])
+            agg['cited_patents_count'] = 1
+        else:
+            agg['cited_patents_count'] = 0
+            agg['discarded_citations'] += 1
+    
+    for row in add_assignees:
+        if (agg['cited_patents_count'] == None):
+            agg['pending_citations'][row] += 1
+        else:
+            agg['assignee_cited_patents_count'][row] += agg['cited_patents_count']
+
+
+def merge_aggregates(agg, other):
+    """
+    Merges two sets of accumulators, as if the patents of other had been aggregated right after those of agg.
+    The merge is associative, so the accumulators of each file can be computed separately and merged in the order of the files.
+    The values pending in other, i.e. credited to its assignees before a first inventor location (resp. citation) was set,
+    are resolved with the last values of agg.
+    
+    Inputs
+    :agg: accumulators, updated in place
+    :other: accumulators of the patents following those of agg, left unchanged
+    
+    Outputs
+    :agg: merged accumulators
+    """
+    
+    agg['patent_type_count'].update(other['patent_type_count'])
+    
+    # id in agg of each location of other
+    location_map = [location_id(agg, location) for location in other['location_keys']]
+    for other_location, count in enumerate(other['location_count']):
+        agg['location_count'][location_map[other_location]] += count
+    
+    for name in ['inventor_keys', 'cited_patents', 'discarded_assignees', 'discarded_inventors']:
+        agg[name] |= other[name]
+    agg['discarded_patents'] += other['discarded_patents']
+    agg['discarded_citations'] += other['discarded_citations']
+    
+    assignee_index = agg['assignee_index']
+    # row in agg of each assignee of other
+    row_map = []
+    
+    for other_row, assignee_id in enumerate(other['assignee_key_id']):
+        if assignee_id not in assignee_index:
+            assignee_index[assignee_id] = len(agg['assignee_key_id'])
+            agg['assignee_key_id'].append(assignee_id)
+            agg['assignee_type'].append(other['assignee_type'][other_row])
+            agg['assignee_org'].append(other['assignee_org'][other_row])
+            agg['assignee_cited_patents_count'].append(0)
+            agg['assignee_patents_count'].append(0)
+        row = assignee_index[assignee_id]
+        row_map.append(row)
+        
+        # pending values were credited at the start of other, with the last values of agg
+        pending = other['pending_locations'][other_row]
+        if (pending) and (agg['inventor_location'] == None):
+            agg['pending_locations'][row] += pending
+        elif (pending):
+            agg['assignee_locations'][(row, agg['inventor_location'])] += pending
+        
+        pending = other['pending_citations'][other_row]
+        if (pending) and (agg['cited_patents_count'] == None):
+            agg['pending_citations'][row] += pending
+        elif (pending):
+            agg['assignee_cited_patents_count'][row] += pending * agg['cited_patents_count']
+        
+        agg['assignee_cited_patents_count'][row] += other['assignee_cited_patents_count'][other_row]
+        agg['assignee_patents_count'][row] += other['assignee_patents_count'][other_row]
+    
+    for (other_row, other_location), count in other['assignee_locations'].items():
+        agg['assignee_locations'][(row_map[other_row], location_map[other_location])] += count
+    
+    if (other['inventor_location'] != None):
+        agg['inventor_location'] = location_map[other['inventor_location']]
+    if (other['cited_patents_count'] != None):
+        agg['cited_patents_count'] = other['cited_patents_count']
+    
+    return agg
+
+
+def is_set(values):
+    """
+    Returns whether each value of a column is set, i.e. neither None nor an empty string
+    
+    Inputs
+    :values: numpy object array
+    
+    Outputs
+    :mask: numpy boolean array
+    """
+    return pd.notna(values) & (values != '')
+
+
+def last_of_patent(patent_rows, values, num_patents):
+    """
+    Returns, for each patent, the value of the last row of that patent,
+    or the value left by the closest previous patent when the patent has no row.
+    This reproduces the values carried from one patent to the next by aggregate_patent().
+    
+    Inputs
+    :patent_rows: numpy int array, sorted patent of each row
+    :values: numpy int array, non-negative value of each row
+    :num_patents: int, total number of patents
+    
+    Outputs
+    :carried: numpy int array, value for each patent, -1 if no previous patent has any row
+    """
+    last = np.full(num_patents, -1)
+    if (len(patent_rows) > 0):
+        is_last = np.append(patent_rows[1:] != patent_rows[:-1], True)
+        last[patent_rows[is_last]] = values[is_last]
+    
+    # forward fill the patents without rows
+    filled = np.maximum.accumulate(np.where(last >= 0, np.arange(num_patents), -1))
+    
+    return np.where(filled >= 0, last[filled], -1)
+
+
+def aggregate_tables(tables_list):
+    """
+    Vectorized equivalent of aggregate_patent(), computing the accumulators with group-bys over whole columns of the
+    normalized tables instead of one patent record at a time.
+    
+    Inputs
+    :tables_list: list of normalized tables, as returned by storage.load_tables(), in the order of the files
+    
+    Outputs
+    :agg: accumulators, in the same format as filled by aggregate_patent()
+    """
+    
+    columns = collections.defaultdict(list)
+    num_patents = 0
+    
+    # concatenate the tables of all files, with a single numbering of the patents
+    for tables in tables_list:
+        for name in ['inventors.patent', 'assignees.patent', 'citations.patent']:
+            columns[name].append(read_column(tables, name) + num_patents)
+        for name in ['patents.patent_type', 'inventors.inventor_key_id', 'inventors.inventor_latitude', 'inventors.inventor_longitude',
+                     'assignees.assignee_key_id', 'assignees.assignee_organization', 'assignees.assignee_type',
+                     'citations.cited_patent_number']:
+            columns[name].append(read_column(tables, name))
+        num_patents += len(columns['patents.patent_type'][-1])
+        
+        for i in range(int(tables['empty_pages'])):
+            print('error: empty page')
+    
+    columns = {name : np.concatenate(columns[name]) for name in columns}
+    agg = init_aggregates()
+    
+    # see Methodology notebook for description of the process
+    patent_type = columns['patents.patent_type']
+    valid_patent = is_set(patent_type) & (patent_type != 'reissue')
+    agg['discarded_patents'] = int(np.sum(~valid_patent))
+    types = pd.Series(patent_type[valid_patent], dtype = object)
+    agg['patent_type_count'] = collections.Counter(types.groupby(types, sort = False).size().to_dict())
+    
+    # only keep the rows of the valid patents
+    for table in ['inventors', 'assignees', 'citations']:
+        keep = valid_patent[columns[table + '.patent']]
+        for name in columns:
+            if (name.startswith(table + '.')):
+                columns[name] = columns[name][keep]
+    
+    # INVENTORS
+    key = columns['inventors.inventor_key_id']
+    lat = columns['inventors.inventor_latitude']
+    valid = (lat != '0.1') & pd.notna(lat) & is_set(key)
+    agg['inventor_keys'] = set(key[valid].tolist())
+    agg['discarded_inventors'] = set(key[~valid].tolist())
+    
+    # number the locations in order of first appearance
+    coordinates = pd.DataFrame({'lat' : lat[valid].astype(float),
+                                'lon' : columns['inventors.inventor_longitude'][valid].astype(float)})
+    location_codes = coordinates.groupby(['lat', 'lon'], sort = False, dropna = False).ngroup().values
+    first = np.unique(location_codes, return_index = True)[1]
+    agg['location_keys'] = list(zip(coordinates['lat'].values[first].tolist(), coordinates['lon'].values[first].tolist()))
+    agg['location_index'] = dict(zip(agg['location_keys'], range(len(first))))
+    agg['location_count'] = np.bincount(location_codes, minlength = len(first)).tolist()
+    
+    carried_location = last_of_patent(columns['inventors.patent'][valid], location_codes, num_patents)
+    
+    # CITATIONS
+    number = columns['citations.cited_patent_number']
+    valid = is_set(number)
+    agg['cited_patents'] = set(number[valid].tolist())
+    agg['discarded_citations'] = int(np.sum(~valid))
+    
+    carried_citations = last_of_patent(columns['citations.patent'], valid.astype(int), num_patents)
+    
+    # ASSIGNEES
+    key = columns['assignees.assignee_key_id']
+    valid = is_set(key) & is_set(columns['assignees.assignee_type'])
+    agg['discarded_assignees'] = set(key[~valid].tolist())
+    
+    # number the assignees in order of first appearance, with the organization and type of their first appearance
+    assignee_codes, assignee_key_id = pd.factorize(key[valid])
+    first = np.unique(assignee_codes, return_index = True)[1]
+    num_assignees = len(assignee_key_id)
+    assignee_patents = columns['assignees.patent'][valid]
+    
+    agg['assignee_key_id'] = list(assignee_key_id)
+    agg['assignee_index'] = dict(zip(agg['assignee_key_id'], range(num_assignees)))
+    agg['assignee_org'] = columns['assignees.assignee_organization'][valid][first].tolist()
+    agg['assignee_type'] = columns['assignees.assignee_type'][valid][first].tolist()
+    agg['assignee_patents_count'] = np.bincount(assignee_codes, minlength = num_assignees).tolist()
+    agg['assignee_cited_patents_count'] = np.bincount(assignee_codes, weights = carried_citations[assignee_patents].clip(min = 0),
+                                                      minlength = num_assignees).astype(int).tolist()
+    
+    # assignees credited before a first value was set (see merge_aggregates)
+    pending = carried_citations[assignee_patents] < 0
+    agg['pending_citations'] = collections.Counter(pd.Series(assignee_codes[pending]).value_counts().to_dict())
+    pending = carried_location[assignee_patents] < 0
+    agg['pending_locations'] = collections.Counter(pd.Series(assignee_codes[pending]).value_counts().to_dict())
+    
+    # count the (assignee, location) pairs
+    pairs = pd.DataFrame({'assignee' : assignee_codes, 'location' : carried_location[assignee_patents]})
+    pairs = pairs[pairs['location'] >= 0].groupby(['assignee', 'location']).size()
+    agg['assignee_locations'] = collections.Counter(dict(zip(pairs.index.tolist(), pairs.values.tolist())))
+    
+    # the values left by the last patent
+    if (num_patents > 0) and (carried_location[-1] >= 0):
+        agg['inventor_location'] = int(carried_location[-1])
+    if (num_patents > 0) and (carried_citations[-1] >= 0):
+        agg['cited_patents_count'] = int(carried_citations[-1])
+    
+    return agg
+
+
+@metrics.timed('format_aggregates')
+def format_aggregates(agg):
+    """
+    Converts the accumulators to the output format of preprocess_data()
+    
+    Inputs
+    :agg: accumulators, as filled by aggregate_patent(), or merged by merge_aggregates()
+    
+    Outputs
+    :output: dictionary, see preprocess_data()
+    """
+    
+    # values still pending are dropped, as there is no previous patent to take them from
+    
+    # number of inventors of each assignee at each location, as a sparse matrix in compressed sparse row format:
+    # the inventors of the assignee at row i are at the locations indices[indptr[i]:indptr[i+1]], in number data[indptr[i]:indptr[i+1]]
+    num_assignees = len(agg['assignee_key_id'])
+    pairs = np.array(list(agg['assignee_locations'].keys()), dtype = np.int64).reshape(-1, 2)
+    counts = np.array(list(agg['assignee_locations'].values()), dtype = np.int64)
+    order = np.lexsort((pairs[:,1], pairs[:,0]))
+    assignee_locations = {'indptr' : np.append(0, np.cumsum(np.bincount(pairs[:,0], minlength = num_assignees))),
+                          'indices' : pairs[order,1],
+                          'data' : counts[order]}
+    
+    assignee_info = pd.DataFrame(data = {'organization' : agg['assignee_org'],
+                                         'type' : agg['assignee_type'],
+                                         'inventors' : np.bincount(pairs[:,0], weights = counts, minlength = num_assignees).astype(np.int64),
+                                         'location_row' : np.arange(num_assignees),
+                                         'patents' : agg['assignee_patents_count'],
+                                         'citations' : agg['assignee_cited_patents_count']}, index = agg['assignee_key_id'])
+    assignee_info.sort_values(by = 'patents', ascending=False, inplace=True)
+    
+    patent_type_count_df = pd.DataFrame.from_dict(agg['patent_type_count'], orient='index').reset_index()
+    patent_type_count_df.set_index('index', inplace=True)
+    
+    total_location_count_df = pd.DataFrame.from_dict(dict(zip(agg['location_keys'], agg['location_count'])), orient='index').reset_index()
+    total_location_count_df.set_index('index', inplace=True)
+
+    output = {'num_by_patent_type' : patent_type_count_df / sum(patent_type_count_df.values),
+              'locations' : total_location_count_df,
+              'num_patents' : sum(patent_type_count_df.values)[0],
+              'num_citations' : len(agg['cited_patents']),
+              'num_inventors' : len(agg['inventor_keys']),
+              'assignees' : assignee_info,
+              'assignee_locations' : assignee_locations,
+              'discarded' : (agg['discarded_patents'], agg['discarded_citations'],
+                             len(agg['discarded_assignees']), len(agg['discarded_inventors']))}
+    output['metrics'] = compute_metrics(output)
+    
+    return output
+
+
+def compute_metrics(output):
+    """
+    Computes the summary metrics of a year of preprocessed data, in a single pass over the assignees
+    
+    Inputs
+    :output: preprocessed data of the year, as returned by preprocess_data()
+    
+    Outputs
+    :values: dictionary, format {metric : value}, with the numbers of patents (all, utility, design and other types),
+              citations, inventors, assignees, individual assignees and assignees of each type ('assignees_type_<type>'),
+              the average numbers of citations and inventors per patent, and the numbers of discarded datapoints
+    """
+    num_patents = int(output['num_patents'])
+    patent_types = (output['num_by_patent_type'][0] * num_patents).round().astype(int)
+    assignee_types = output['assignees']['type'].value_counts()
+    
+    values = {'patents' : num_patents,
+              'utility_patents' : int(patent_types.get('utility', 0)),
+              'design_patents' : int(patent_types.get('design', 0)),
+              'citations' : output['num_citations'],
+              'inventors' : output['num_inventors'],
+              'assignees' : len(output['assignees']),
+              # types 4 and 5 are US and non-US individuals
+              'individuals' : int(assignee_types.get('4', 0) + assignee_types.get('5', 0)),
+              'citations_per_patent' : output['num_citations'] / num_patents if num_patents else np.nan,
+              'inventors_per_patent' : output['num_inventors'] / num_patents if num_patents else np.nan}
+    values['other_patents'] = num_patents - values['utility_patents'] - values['design_patents']
+    
+    for assignee_type in sorted(assignee_types.index):
+        values['assignees_type_' + str(assignee_type)] = int(assignee_types[assignee_type])
+    
+    for name, value in zip(['patents', 'citations', 'assignees', 'inventors'], output['discarded']):
+        values['discarded_' + name] = value
+    
+    return values
+
+
+def preprocess_partial(file_, stream = False, cache = False, backend = 'python'):
+    """
+    Preprocesses a single saved json file to accumulators, which can then be merged with those of other files (see merge_aggregates).
+    
+    Input
+    :file_: path to the file containing the json data
+    :stream: if True, the file is parsed incrementally, one patent record at a time, instead of being loaded whole
+    :cache: if True, the records are read from the normalized tables cached next to the file (see storage.load_tables),
+            and the accumulators are cached next to the file as well, so that they are only computed again when the file changes
+    :backend: 'python' or 'vectorized' (see preprocess_data)
+    
+    Output
+    :agg: accumulators of the file, as filled by aggregate_patent()
+    """
+    
+    if (backend != 'python') and (backend != 'vectorized'):
+        raise ValueError('unknown backend ' + str(backend))
+    
+    print(file_)
+    partial_file = strip_extension(file_) + '.partial.pkl'
+    stamp = source_stamp(file_) + [AGGREGATES_VERSION]
+    
+    if (cache) and os.path.isfile(partial_file):
+        with open(partial_file, 'rb') as f:
+            cached = pickle.load(f)
+        if (cached['source'] == stamp):
+            metrics.count('partial_cache_hits')
+            return cached['agg']
+    
+    if (backend == 'vectorized'):
+        tables = load_tables(file_, stream)
+        with metrics.timer('aggregate'):
+            agg = aggregate_tables([tables])
+    
+    else:
+        agg = init_aggregates()
+        
+        if (cache):
+            patents = iter_cached_patents(load_tables(file_, stream))
+        else:
+            patents = iter_patents(file_, stream)
+        
+        # includes the parsing of the records when they are streamed
+        with metrics.timer('aggregate'):
+            for patent in patents:
+                # when query limit is reached, the results are empty pages
+                if (patent != None):
+                    aggregate_patent(agg, patent)
+                else:
+                    print('error: empty page')
+    
+    metrics.count('records', sum(agg['patent_type_count'].values()) + agg['discarded_patents'])
+    
+    if (cache):
+        # write to a temporary file first, so that an interrupted run does not leave a corrupted cache behind
+        with open(partial_file + '.tmp', 'wb') as f:
+            pickle.dump({'source' : stamp, 'agg' : agg}, f)
+        os.replace(partial_file + '.tmp', partial_file)
+    
+    return agg
+
+
+@metrics.timed('preprocess_data')
+def preprocess_data(files, stream = False, cache = False, backend = 'python'):
     """
     Preprocesses saved json data from file to the format used for the data analysis. (see Methodology notebook)
 
     Input
     :files: path to files containing the json data, format ['file1','file2',...]
+    :stream: if True, the files are parsed incrementally, one patent record at a time, instead of being loaded whole
+    :cache: if True, the records are read from the normalized tables cached next to each file (see storage.load_tables),
+            and the accumulators of each file are cached as well (see preprocess_partial)
+    :backend: 'python' to aggregate one patent record at a time (see aggregate_patent), 
+              'vectorized' to aggregate whole columns of the normalized tables at once (see aggregate_tables).
+              The vectorized backend always reads the cached normalized tables.
 
     Output
     :num_by_patent_type: proportion of patents in each patent type,
@@ -178,118 +673,55 @@ def preprocess_data(files):
     :num_patents: total number of patent applications,
     :num_citations: total number of citations by all patent applications,
     :num_inventors: total number of inventors listed in all the patent applications,
-    :assignees: dataframe, list of all unique assignees with their type, number of patents, number of citations, and a :location:-like list specific to that assignee}
+    :assignees: dataframe, list of all unique assignees with their type, number of inventors, number of patents, number of citations,
+                and the row of the assignee in :assignee_locations:
+    :assignee_locations: sparse matrix of the number of inventors of each assignee at each location, i.e. a :locations:-like list
+                         specific to each assignee, format {'indptr', 'indices', 'data'} (see format_aggregates).
+                         Locations are identified by their row in :locations:
     :discarded: number of datapoints discarded (see Methodology notebook)
     """
     
-    discarded_patents = 0
-    discarded_assignees = []
-    discarded_inventors = []
-    discarded_citations = 0
-    
-    assignee_key_id = []
-    assignee_org = []
-    assignee_inventor_locations = []
-    assignee_cited_patents_count = []
-    assignee_patents_count = []
-    assignee_type = []
-    
-    total_inventor_count = collections.Counter()
-    total_location_count = collections.Counter()
-    total_cited_patents_count = collections.Counter()
-    patent_type_count = collections.Counter()
-
-    # parse json data and fill above objects
-    for file_ in files: 
-        print(file_)
-        # load json data file
-        json_data = json.load(open(file_, encoding = 'utf-8'))
-
-        for page in json_data:
-            # when query limit is reached, the results are empty pages
-            if (json_data[page]['patents'] != None):
-                
-                for patent in json_data[page]['patents']:
-                    patent_type = patent['patent_type']
-                    
-                    # see Methodology notebook for description of the process
-                    if (patent_type != 'reissue') and (patent_type != None) and (patent_type != ''):
-                        patent_type_count[patent_type] += 1
-                        add_assignees = []
-                        
-                        for assignee in patent['assignees']:
-                            assignee_id = assignee['assignee_key_id']
-                            if (assignee_id not in assignee_key_id) and (assignee_id) and (assignee['assignee_type']):
-                                assignee_key_id.append(assignee_id)
-                                assignee_type.append(assignee['assignee_type'])
-                                assignee_org.append(assignee['assignee_organization'])
-                                assignee_inventor_locations.append(collections.Counter())
-                                assignee_cited_patents_count.append(0)
-                                assignee_patents_count.append(0)
-                            if (assignee_id) and (assignee['assignee_type']):
-                                add_assignees.append(assignee_id)
-                                assignee_patents_count[assignee_key_id.index(assignee_id)] += 1
-                            else:
-                                if assignee['assignee_key_id'] not in discarded_assignees:
-                                    discarded_assignees.append(assignee['assignee_key_id'])
-                            
-                        for inventor in patent['inventors']:
-                            lat = inventor['inventor_latitude']
-                            lon = inventor['inventor_longitude']
-                            if (lat != '0.1') and (lat != None) and (inventor['inventor_key_id']):
-                                inventor_locations = collections.Counter()
-                                inventor_locations[(float(lat), float(lon))] += 1
-                                total_location_count[(float(lat), float(lon))] += 1
-                                total_inventor_count[inventor['inventor_key_id']] = 1
-                            else:
-                                if inventor['inventor_key_id'] not in discarded_inventors:
-                                    discarded_inventors.append(inventor['inventor_key_id'])
-                                
-                        for assignee in add_assignees:
-                            assignee_inventor_locations[assignee_key_id.index(assignee)] += inventor_locations
-                            
-                        for cit_patent in patent['cited_patents']:
-                            cited_patents_count = 0
-                            if (cit_patent['cited_patent_number']):
-                                total_cited_patents_count[cit_patent['cited_patent_number']] = 1
-                                cited_patents_count += 1
-                            else:
-                                discarded_citations += 1
-
-                        for assignee in add_assignees:
-                            assignee_cited_patents_count[assignee_key_id.index(assignee)] += cited_patents_count
-                            
-                    else:
-                        discarded_patents += 1
-                            
-            else:
-                print('error: empty page')
-    
-    # output formats
-    assignee_info = pd.DataFrame(data = {'organization' : assignee_org,
-                                         'type' : assignee_type,
-                                         'inventors_loc' : assignee_inventor_locations,
-                                         'patents' : assignee_patents_count,
-                                         'citations' : assignee_cited_patents_count}, index = assignee_key_id)
-    assignee_info.sort_values(by = 'patents', ascending=False, inplace=True)
+    agg = init_aggregates()
     
-    patent_type_count_df = pd.DataFrame.from_dict(patent_type_count, orient='index').reset_index()
-    patent_type_count_df.set_index('index', inplace=True)
+    for file_ in files:
+        merge_aggregates(agg, preprocess_partial(file_, stream, cache, backend))
     
-    total_location_count_df = pd.DataFrame.from_dict(total_location_count, orient='index').reset_index()
-    total_location_count_df.set_index('index', inplace=True)
-
-    output = {'num_by_patent_type' : patent_type_count_df / sum(patent_type_count_df.values),
-              'locations' : total_location_count_df,
-              'num_patents' : sum(patent_type_count_df.values)[0],
-              'num_citations' : len(total_cited_patents_count),
-              'num_inventors' : len(total_inventor_count),
-              'assignees' : assignee_info,
-              'discarded' : (discarded_patents, discarded_citations, len(discarded_assignees), len(discarded_inventors))}
+    output = format_aggregates(agg)
+    for name, value in zip(['patents', 'citations', 'assignees', 'inventors'], output['discarded']):
+        metrics.count('discarded_' + name, value)
     
     return output
 
-def get_full_year_data(year, filepath):
+def plan_date_windows(app_date_from, app_date_to, max_results = MAX_RESULTS):
+    """
+    Splits a range of application dates into windows which each have less results than the query limit.
+    Counts the results of the whole range first, then recursively bisects it, down to single days if needed, 
+    until each window fits under the limit.
+    
+    Inputs
+    :app_date_*: string type, format 'YYYY-MM-DD'
+    :max_results: int, maximum number of results of a single query
+    
+    Outputs
+    :windows: list of (app_date_from, app_date_to, count), in chronological order
+    """
+    count = count_results(query(app_date_from, app_date_to, None))
+    date_from = datetime.date.fromisoformat(app_date_from)
+    date_to = datetime.date.fromisoformat(app_date_to)
+    
+    if (count <= max_results) or (date_from == date_to):
+        if (count > max_results):
+            print('page limit reached for', app_date_from, ', double check data')
+        return [(app_date_from, app_date_to, count)]
+    
+    middle = date_from + (date_to - date_from) // 2
+    print(app_date_from, app_date_to, count, 'results, splitting at', middle.isoformat())
+    
+    return (plan_date_windows(app_date_from, middle.isoformat(), max_results) + 
+            plan_date_windows((middle + datetime.timedelta(days = 1)).isoformat(), app_date_to, max_results))
+
+
+def get_full_year_data(year, filepath, workers = 4, adaptive = False, compress = False, use_cache = True, refresh = False):
     """
     Fetches data for a full year, one quarter at a time, to deal with the PatentsView limits.
     If the data is not already on file, fetches data and saves it to filepath.
@@ -297,35 +729,92 @@ def get_full_year_data(year, filepath):
     Inputs
     :year: string type, years for which data is requested
     :filepath: string type, local directory for loading saved data / saving new data
+    :workers: int, maximum number of quarters (or windows) fetched at the same time. 
+              All requests share the same rate limit (see fetcher.fetch_page)
+    :adaptive: if True, the year is split into windows which each fit under the query limit (see plan_date_windows),
+               instead of fixed quarters. The windows are saved to filepath, so that the year is only planned once.
+    :compress: if True, the data is saved as gzip compressed json lines (see patentsviewAPI). 
+               Data already on file is used whichever its format
+    :use_cache: if False, the response cache is bypassed, so that the quarters which are not on file yet are fetched up to date (see get_data)
+    :refresh: if True, the quarters already on file are fetched again, bypassing the response cache, and replace the files on disk,
+              e.g. to include the patents whose record changed since they were fetched
     
     Outputs
     :output_datafiles: list of paths to files containing the data for the full year
     """
     
-    filenames = [year + q for q in ['q1','q2','q3','q4']]
-    date_from = [year + '-' + date for date in ['01-01','04-01','07-01','10-01']]
-    date_to = [year + '-' + date for date in ['03-31','06-30','09-30','12-31']]
-
-    output_datafiles = []
+    if (adaptive):
+        plan_file = os.path.join(filepath, year + '_windows.json')
+        if os.path.isfile(plan_file):
+            windows = json.load(open(plan_file))
+        else:
+            windows = plan_date_windows(year + '-01-01', year + '-12-31')
+            with open(plan_file, 'w') as f:
+                json.dump(windows, f)
+        
+        filenames = [year + '_' + window[0] + '_' + window[1] for window in windows]
+        date_from = [window[0] for window in windows]
+        date_to = [window[1] for window in windows]
     
-    for i,filename in enumerate(filenames):
-        print(filepath,filename)
-        if os.path.isfile(os.path.join(filepath,filename + '.json')):
-            datafile = os.path.join(filepath,filename + '.json')
+    else:
+        filenames = [year + q for q in ['q1','q2','q3','q4']]
+        date_from = [year + '-' + date for date in ['01-01','04-01','07-01','10-01']]
+        date_to = [year + '-' + date for date in ['03-31','06-30','09-30','12-31']]
+
+    def get_quarter(i):
+        print(filepath,filenames[i])
+        datafile = find_raw_file(filepath, filenames[i])
+        if (datafile) and not (refresh):
             print('already on file')
-        else:
-            datafile = patentsviewAPI(filename, filepath = filepath, app_date_from = date_from[i], app_date_to = date_to[i])
-        output_datafiles.append(datafile)
+            return datafile
+        datafile = patentsviewAPI(filenames[i], filepath = filepath, app_date_from = date_from[i], app_date_to = date_to[i],
+                                  compress = compress, use_cache = use_cache and not refresh)
+        # the file fetched before in another format would otherwise still be found first by find_raw_file
+        for extension in RAW_EXTENSIONS:
+            old_file = os.path.join(filepath, filenames[i] + extension)
+            if (old_file != datafile) and os.path.isfile(old_file):
+                os.remove(old_file)
+        return datafile
+    
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        output_datafiles = list(executor.map(get_quarter, range(len(filenames))))
         
     return output_datafiles
 
 
-def get_ts(full_year_data):
+def get_metrics_table(full_year_data):
+    """
+    Returns the summary metrics of all years in a single table (see compute_metrics)
+    
+    Inputs
+    :full_year_data: entire dataset as returned by the load_data() function
+    
+    Outputs
+    :metrics_table: DataFrame indexed by year, one column per metric, 0 for the assignee types absent from a year
+    """
+    metrics_table = {}
+    for year in full_year_data:
+        if ('metrics' in full_year_data[year]):
+            metrics_table[int(year)] = full_year_data[year]['metrics']
+        else:
+            metrics_table[int(year)] = compute_metrics(full_year_data[year])
+    
+    metrics_table = pd.DataFrame.from_dict(metrics_table, orient = 'index')
+    metrics_table.index.name = 'year'
+    
+    assignee_types = [column for column in metrics_table.columns if column.startswith('assignees_type_')]
+    metrics_table[assignee_types] = metrics_table[assignee_types].fillna(0).astype(int)
+    
+    return metrics_table
+
+
+def get_ts(full_year_data, metrics_table = None):
     """
     Extracts time series data from the dataset.
     
     Inputs
     :full_year_data: entire dataset as returned by the load_data() function
+    :metrics_table: (optional) as returned by get_metrics_table, to avoid building it again
     
     Outputs
     :num_patents_ts: number of patent applications for each year
@@ -335,30 +824,17 @@ def get_ts(full_year_data):
     :num_design_patents_ts: number of design patent applications in each year
     :num_individuals_ts: number of individuals listed as assignees in patent applications in each year
     """
+    if (metrics_table is None):
+        metrics_table = get_metrics_table(full_year_data)
     
-    num_patents_ts = []
-    num_inventors_ts = []
-    num_individuals_ts = []
-    num_citations_ts = []
-    num_utility_patents_ts = []
-    num_design_patents_ts = []
-    
-    for year in full_year_data:
-        num_patents_ts.append(full_year_data[year]['num_patents'])
-        num_inventors_ts.append(full_year_data[year]['num_inventors'])
-        num_citations_ts.append(full_year_data[year]['num_citations'])
-        num_utility_patents_ts.append(full_year_data[year]['num_by_patent_type'].loc['utility'] * num_patents_ts[-1])
-        num_design_patents_ts.append(full_year_data[year]['num_by_patent_type'].loc['design'] * num_patents_ts[-1])
-        num_individuals_ts.append(len(full_year_data[year]['assignees'].query("type == '4' | type == '5'")))
-    
-    # flatten the time series and divide by 1000 to make the scale more readable when plotting the data
+    # divide by 1000 to make the scale more readable when plotting the data
     # number of individuals is low enough as is
-    num_patents_ts = np.array(num_patents_ts).flatten() / 1000
-    num_inventors_ts = np.array(num_inventors_ts).flatten() / 1000
-    num_citations_ts = np.array(num_citations_ts).flatten() / 1000
-    num_utility_patents_ts = np.array(num_utility_patents_ts).flatten() / 1000
-    num_design_patents_ts = np.array(num_design_patents_ts).flatten() / 1000
-    num_individuals_ts = np.array(num_individuals_ts).flatten()
+    num_patents_ts = metrics_table['patents'].values / 1000
+    num_inventors_ts = metrics_table['inventors'].values / 1000
+    num_citations_ts = metrics_table['citations'].values / 1000
+    num_utility_patents_ts = metrics_table['utility_patents'].values / 1000
+    num_design_patents_ts = metrics_table['design_patents'].values / 1000
+    num_individuals_ts = metrics_table['individuals'].values
     
     return num_patents_ts, num_inventors_ts, num_citations_ts, num_utility_patents_ts, num_design_patents_ts, num_individuals_ts
     
@@ -381,13 +857,14 @@ def get_all_locations(data):
     return locations
     
     
-def get_top_k_locations(data, k):
+def get_top_k_locations(data, k, year_data):
     """
     Returns list of locations and the number of inventors at each location, counting only the data from the top k assignees, ranked by number of patent applications.
     
     Inputs
-    :data: preprocessed locations dataframe
+    :data: preprocessed assignees dataframe, sorted by number of patent applications, possibly filtered
     :k: length of sorted locations list to return
+    :year_data: preprocessed data of the year, holding the locations and the assignee_locations matrix of the assignees
     
     Outputs
     :locations: list in format required by Folium
@@ -395,24 +872,144 @@ def get_top_k_locations(data, k):
     :num_inventors: sum of number of inventors for the top k assignees
     """
     assignees = data[['organization', 'patents']].values[:k,:]
-    loc_counters = data['inventors_loc'].values[:k]
-    num_inventors = 0
-    locations = Counter()
+    location_ids, counts = get_matrix_rows(year_data['assignee_locations'], data['location_row'].values[:k])
+    num_inventors = int(counts.sum())
     
-    for counter in loc_counters:
-        num_inventors += sum(counter.values())
-        locations += counter
+    # sum the rows of the top assignees
+    counts = np.bincount(location_ids, weights = counts, minlength = len(year_data['locations']))
+    location_ids = np.nonzero(counts)[0]
+    coordinates = np.array(year_data['locations'].index.tolist(), dtype = float).reshape(-1, 2)
     
-    locations = np.hstack([np.array(list(locations.keys())), 
-                           np.array(list(locations.values()))[:,None]])
+    locations = np.hstack([coordinates[location_ids], counts[location_ids][:,None]])
     
     top = pd.DataFrame({'Top Assignees' : assignees[:,0],
                         'Patent Applications' : assignees[:,1]})
     
     return locations, top, num_inventors
 
+
+def get_matrix_rows(matrix, rows):
+    """
+    Returns the non-zero values of the given rows of a sparse matrix in compressed sparse row format
+    
+    Inputs
+    :matrix: dictionary, format {'indptr', 'indices', 'data'}, as the assignee_locations of preprocess_data()
+    :rows: numpy int array
+    
+    Outputs
+    :indices: numpy int array, column of each value
+    :data: numpy array, values of the rows one after the other
+    """
+    starts = matrix['indptr'][rows]
+    lengths = matrix['indptr'][np.asarray(rows) + 1] - starts
+    
+    # positions of the values of each row in the data array, without looping over the rows
+    positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+    
+    return matrix['indices'][positions], matrix['data'][positions]
+
+
+def save_locations(year_data, file_):
+    """
+    Saves the locations and the assignee_locations matrix of a year to disk, in numpy format
+    
+    Inputs
+    :year_data: preprocessed data of the year, as returned by preprocess_data()
+    :file_: string type, path of the file, should end with '.npz'
+    """
+    coordinates = np.array(year_data['locations'].index.tolist(), dtype = float).reshape(-1, 2)
+    
+    with open(file_ + '.tmp', 'wb') as f:
+        np.savez(f, latitude = coordinates[:,0], longitude = coordinates[:,1],
+                 count = year_data['locations'].values[:,0] if len(year_data['locations']) else np.array([], dtype = np.int64),
+                 **year_data['assignee_locations'])
+    os.replace(file_ + '.tmp', file_)
+
+
+def load_locations(file_):
+    """
+    Loads the locations and the assignee_locations matrix of a year saved by save_locations()
+    
+    Inputs
+    :file_: string type, path of the file
+    
+    Outputs
+    :year_data: dictionary, format {'locations', 'assignee_locations'}, as in the output of preprocess_data()
+    """
+    with np.load(file_) as arrays:
+        keys = list(zip(arrays['latitude'].tolist(), arrays['longitude'].tolist()))
+        locations = pd.DataFrame.from_dict(dict(zip(keys, arrays['count'].tolist())), orient='index').reset_index()
+        locations.set_index('index', inplace=True)
+        assignee_locations = {name : arrays[name] for name in ['indptr', 'indices', 'data']}
+    
+    return {'locations' : locations, 'assignee_locations' : assignee_locations}
+
+    
+def cell_size(zoom, pixels = 4):
+    """
+    Returns the size of the grid cells used to bin locations for a map zoom level
+    
+    Inputs
+    :zoom: int, zoom level of the map, the whole world being 256 pixels wide at zoom level 0
+    :pixels: int, width of a cell in pixels on the map, at the equator
+    
+    Outputs
+    :size: float, size of a cell in degrees
+    """
+    return 360 * pixels / (256 * 2**zoom)
+
+
+def bin_locations(locations, zoom, pixels = 4):
+    """
+    Bins locations into the cells of a latitude / longitude grid, and returns the weighted centroid of each cell.
+    The number of points to draw is then bounded by the number of cells, while the heat map looks the same at the given zoom level.
     
-def load_data(year_range, data_dir):
+    Inputs
+    :locations: list or array of (latitude, longitude, weight), or of (latitude, longitude) with a weight of 1,
+                as returned by get_all_locations and get_top_k_locations, or the inventors of a layer in load_layers_data
+    :zoom: int, highest zoom level at which the map is displayed
+    :pixels: int, width of a cell in pixels on the map (see cell_size)
+    
+    Outputs
+    :binned: numpy array of (latitude, longitude, weight), one row per non-empty cell
+    """
+    locations = np.asarray(locations, dtype = float)
+    if (len(locations) == 0):
+        return np.zeros((0, 3))
+    if (locations.shape[1] == 2):
+        locations = np.hstack([locations, np.ones((len(locations), 1))])
+    
+    size = cell_size(zoom, pixels)
+    rows = np.floor((locations[:,0] + 90) / size).astype(np.int64)
+    columns = np.floor((locations[:,1] + 180) / size).astype(np.int64)
+    cells, cell_codes = np.unique(rows * (int(360 / size) + 2) + columns, return_inverse = True)
+    
+    weights = np.bincount(cell_codes, weights = locations[:,2], minlength = len(cells))
+    latitudes = np.bincount(cell_codes, weights = locations[:,0] * locations[:,2], minlength = len(cells))
+    longitudes = np.bincount(cell_codes, weights = locations[:,1] * locations[:,2], minlength = len(cells))
+    
+    # cells with a total weight of 0 are dropped
+    keep = weights != 0
+    
+    return np.stack([latitudes[keep] / weights[keep], longitudes[keep] / weights[keep], weights[keep]], axis = 1)
+
+
+def get_location_tiles(locations, zooms = range(2, 6), pixels = 4):
+    """
+    Pre-aggregates locations for several zoom levels of a map (see bin_locations)
+    
+    Inputs
+    :locations: as in bin_locations
+    :zooms: zoom levels for which to bin the locations
+    :pixels: int, width of a cell in pixels on the map (see cell_size)
+    
+    Outputs
+    :tiles: dictionary, format {zoom : binned locations}
+    """
+    return {zoom : bin_locations(locations, zoom, pixels) for zoom in zooms}
+
+    
+def load_data(year_range, data_dir, stream = False, cache = False, backend = 'python', workers = None, adaptive = False, compress = False):
     """
     Converts saved jsondata from the PatentsView API to the format that is most useful in answering 
     the research topics stated in Part 1 (See Methodology notebook).
@@ -420,42 +1017,236 @@ def load_data(year_range, data_dir):
     Inputs
     :year_range: range type, range of years for which data is needed
     :data_dir: string type, local directory for loading saved data / saving new data
+    :stream: if True, the saved json data is parsed incrementally (see preprocess_data)
+    :cache: if True, the saved json data is read from the normalized tables cached next to it (see preprocess_data)
+    :backend: 'python' or 'vectorized', aggregation backend (see preprocess_data)
+    :workers: (optional) int, number of processes preprocessing the saved files in parallel. 
+              By default, the files are preprocessed one after the other.
+    :adaptive: if True, each year is fetched in windows which fit under the query limit, instead of quarters (see get_full_year_data)
+    :compress: if True, new data is saved as gzip compressed json lines (see get_full_year_data)
     
     Outputs
     :full_year_data: preprocessed data
     """
 
-    full_year_data = {}
+    years = [str(year) for year in year_range]
+    
+    # the data is fetched first, in this process: one year after the other, with the quarters of a year fetched by threads
+    # which share the rate limit of the PatentsView API (see get_full_year_data). Only the preprocessing runs in the worker processes
+    datafiles = [get_full_year_data(year, data_dir, adaptive = adaptive, compress = compress) for year in years]
+    print('loading data from disk')
+    
+    if (workers):
+        # each process only sends back the accumulators of one file, and the accumulators are collected 
+        # in the order of the files whichever process finishes first, then merged year by year
+        all_files = [file_ for files in datafiles for file_ in files]
+        with ProcessPoolExecutor(max_workers = workers) as executor:
+            partials = iter(executor.map(preprocess_partial, all_files, repeat(stream), repeat(cache), repeat(backend)))
+        
+            outputs = []
+            for files in datafiles:
+                agg = init_aggregates()
+                for file_ in files:
+                    merge_aggregates(agg, next(partials))
+                outputs.append(format_aggregates(agg))
+    else:
+        outputs = [preprocess_data(files, stream, cache, backend) for files in datafiles]
 
-    for year in year_range:
-        datafiles = get_full_year_data(str(year), data_dir)
-        print('loading data from disk')
-        full_year_data[str(year)] = preprocess_data(datafiles)
+    full_year_data = dict(zip(years, outputs))
 
     return full_year_data
 
 
-def get_assignee_ts(full_year_data, assignees):
+def record_digest(patent):
     """
-    Returns the time series of the number of inventors for the specified assignees
+    Returns a digest of the content of a patent record, to detect records which changed since they were fetched
+    
+    Inputs
+    :patent: dictionary, patent record
+    
+    Outputs
+    :digest: string type
+    """
+    return hashlib.blake2b(json.dumps(patent, sort_keys = True).encode('utf-8'), digest_size = 8).hexdigest()
+
+
+def application_date(patent):
+    """
+    Returns the application date of a patent record, None if the record does not include it
+    
+    Inputs
+    :patent: dictionary, patent record
+    
+    Outputs
+    :app_date: string type, format 'YYYY-MM-DD'
+    """
+    dates = [application['app_date'] for application in (patent.get('applications') or []) if application.get('app_date')]
+    if (patent.get('app_date')):
+        dates.append(patent['app_date'])
+    return max(dates) if dates else None
+
+
+def init_update_state(year, filepath, compress = False, refresh = False):
+    """
+    Creates the state of the incremental updates of a year (see update_year_data), from the full year data,
+    which is fetched first if it is not already on file.
+    
+    Inputs
+    :year: string type, year of the data
+    :filepath: string type, local directory for loading saved data / saving new data
+    :compress: if True, new data is saved as gzip compressed json lines (see get_full_year_data)
+    :refresh: if True, the full year data is fetched again even if it is already on file (see get_full_year_data)
+    
+    Outputs
+    :state: dictionary, format {'last_app_date', 'digests', 'files', 'agg'}
+    """
+    files = get_full_year_data(year, filepath, compress = compress, refresh = refresh)
+    state = {'last_app_date' : year + '-01-01', 'digests' : {}, 'files' : files, 'agg' : init_aggregates()}
+    
+    for file_ in files:
+        for patent in iter_patents(file_, stream = True):
+            if (patent == None):
+                continue
+            if ('patent_number' not in patent):
+                raise ValueError(file_ + ' was fetched without patent numbers, delete the data of ' + year + ' and fetch it again to use incremental updates')
+            state['digests'][patent['patent_number']] = record_digest(patent)
+            if (application_date(patent)):
+                state['last_app_date'] = max(state['last_app_date'], application_date(patent))
+        merge_aggregates(state['agg'], preprocess_partial(file_))
+    
+    return state
+
+
+def update_year_data(year, filepath, app_date_to = None, lookback = 0, compress = False, refresh = False):
+    """
+    Updates the preprocessed data of a year with the patents published since the last update, instead of fetching the full year again.
+    The state of the updates (latest application date, digest of each patent already ingested, and accumulators) is saved to filepath.
+    Only the applications filed on or after the latest application date already ingested (minus lookback days) are fetched, and among them,
+    only the patents which were not ingested yet are added to the accumulators, as if they came after all the previous data (see merge_aggregates).
+    
+    The accumulators cannot remove a patent, so patents whose record changed since they were ingested are not updated,
+    only reported: for their changes to be included, the update is run again with refresh = True, which fetches the full year again,
+    bypassing the response cache, and rebuilds the state from it.
+    
+    Inputs
+    :year: string type, year of the data
+    :filepath: string type, local directory for loading saved data / saving new data
+    :app_date_to: (optional) string type, format 'YYYY-MM-DD', last application date to fetch, by default the end of the year or today
+    :lookback: int, number of days before the latest application date already ingested to fetch again,
+               to pick up the applications which are published long after they are filed
+    :compress: if True, new data is saved as gzip compressed json lines
+    :refresh: if True, the saved state is discarded, and rebuilt from the full year data fetched again (see get_full_year_data)
+    
+    Outputs
+    :output: preprocessed data of the year, in the format of preprocess_data()
+    :report: dictionary, format {'new' : number of patents added, 'unchanged' : number of patents already ingested,
+             'changed' : list of the patent numbers whose record changed since they were ingested}
+    """
+    state_file = os.path.join(filepath, year + '_state.pkl')
+    if os.path.isfile(state_file) and not (refresh):
+        with open(state_file, 'rb') as f:
+            state = pickle.load(f)
+    else:
+        state = init_update_state(year, filepath, compress, refresh)
+    
+    if (app_date_to == None):
+        app_date_to = min(year + '-12-31', datetime.date.today().isoformat())
+    
+    # the applications of the latest date may not all have been published at the last update, so that date is fetched again
+    app_date_from = datetime.date.fromisoformat(state['last_app_date']) - datetime.timedelta(days = lookback)
+    app_date_from = max(app_date_from.isoformat(), year + '-01-01')
+    print('fetching updates from', app_date_from, 'to', app_date_to)
+    # the same dates are queried at each update, so the response cache is bypassed to get the patents published since
+    data = fetch_query(*query_parts(app_date_from, app_date_to), use_cache = False)
+    
+    report = {'new' : 0, 'unchanged' : 0, 'changed' : []}
+    new_patents = []
+    for patent in walk_patents(data):
+        if (patent == None):
+            print('page limit reached for the update, double check data')
+            continue
+        digest = record_digest(patent)
+        number = patent['patent_number']
+        if (number not in state['digests']):
+            new_patents.append(patent)
+            state['digests'][number] = digest
+        elif (state['digests'][number] == digest):
+            report['unchanged'] += 1
+        else:
+            report['changed'].append(number)
+        if (application_date(patent)):
+            state['last_app_date'] = max(state['last_app_date'], application_date(patent))
+    report['new'] = len(new_patents)
+    
+    if (new_patents):
+        # the new patents are saved as a data file of their own, so that preprocess_data(state['files']) gives the same output
+        filename = year + '_update' + str(len(state['files'])) + ('.jsonl.gz' if compress else '.json')
+        file_ = os.path.join(filepath, filename)
+        if (compress):
+            write_patents(new_patents, file_)
+        else:
+            with open(file_, 'w') as f:
+                json.dump({0 : {1 : {'patents' : new_patents, 'count' : len(new_patents)}}}, f)
+        
+        merge_aggregates(state['agg'], preprocess_partial(file_))
+        state['files'].append(file_)
+    
+    # write to a temporary file first, so that an interrupted run does not leave a corrupted state behind
+    with open(state_file + '.tmp', 'wb') as f:
+        pickle.dump(state, f)
+    os.replace(state_file + '.tmp', state_file)
+    
+    print(report['new'], 'new patents,', report['unchanged'], 'unchanged,', len(report['changed']), 'changed')
+    if (report['changed']):
+        print('changed patents are not updated, run the update again with refresh = True to include the changes')
+    
+    return format_aggregates(state['agg']), report
+
+
+
+def get_assignee_table(full_year_data):
+    """
+    Returns the per-year statistics of all the assignees in a single table, with the number of inventors precomputed.
+    When an organization appears several times in the same year, only its first row is kept, i.e. the one with the most patents.
     
     Inputs
     :full_year_data: all data
     
     Outputs
+    :table: DataFrame indexed by (year, organization), columns ['inventors', 'patents', 'citations']
+    """
+    tables = []
+    for year in full_year_data:
+        assignees = full_year_data[year]['assignees']
+        assignees = assignees[assignees['organization'].notna()].drop_duplicates('organization')
+        tables.append(pd.DataFrame({'year' : int(year),
+                                    'organization' : assignees['organization'].values,
+                                    'inventors' : assignees['inventors'].values,
+                                    'patents' : assignees['patents'].values,
+                                    'citations' : assignees['citations'].values}))
+    
+    return pd.concat(tables, ignore_index = True).set_index(['year', 'organization']).sort_index()
+
+
+def get_assignee_ts(full_year_data, assignees, table = None):
+    """
+    Returns the time series of the number of inventors for the specified assignees
+    
+    Inputs
+    :full_year_data: all data
     :assignees: list of assignees for which to get the time series
+    :table: (optional) as returned by get_assignee_table, to avoid building it again for each call
+    
+    Outputs
+    :ts: DataFrame indexed by year, one column per assignee, 0 for the years without data for an assignee
     """
+    if (table is None):
+        table = get_assignee_table(full_year_data)
     
-    ts = pd.DataFrame(columns = assignees, index = np.array(list(full_year_data.keys())).astype('int'))
+    years = np.array(list(full_year_data.keys())).astype('int')
+    ts = table['inventors'].unstack('organization').reindex(index = years, columns = assignees).fillna(0).astype(int)
+    ts.columns.name = None
     
-    for year in full_year_data:
-        for assignee in assignees:
-            counter = full_year_data[year]['assignees'].query('organization == @assignee')['inventors_loc'].values
-            if len(counter) > 0:
-                ts[assignee][int(year)] = sum(counter[0].values())
-            else:
-                ts[assignee][int(year)] = 0
-     
     return ts
 
 """
@@ -464,7 +1255,7 @@ FUNCTIONS TO PRE-PROCESS DATA
 FUNCTIONS FOR PART 2
 """
 
-def load_layers_data(filename, patent_number, layers, data_dir):
+def load_layers_data(filename, patent_number, layers, data_dir, stream = False, cache = False, concurrency = None, compress = False, graph_dir = None):
     """
     Converts saved jsondata from the PatentsView API to the format that is most useful in answering 
     the research topics stated in Part 2 (See Methodology notebook).
@@ -474,21 +1265,28 @@ def load_layers_data(filename, patent_number, layers, data_dir):
     :patent_number: format ['key1','key'1,...], patent_numbers to query
     :layers: int, number of layers for which to get data
     :data_dir: local directory of for saved data
+    :stream: if True, the saved raw json data is parsed incrementally (see preprocess_layer_data)
+    :cache: if True, the saved raw json data is read from the normalized tables cached next to it (see preprocess_layer_data)
+    :concurrency: (optional) int, if given the layers are fetched with the asyncio crawler (see get_layers_data)
+    :compress: if True, the data is saved gzip compressed (see get_layers_data)
+    :graph_dir: (optional) string type, directory of the citation graph to update with the crawled patents (see get_layers_data)
     
     Outputs
     :file_: preprocessed data
     """
-    file_ = get_layers_data(filename, data_dir, patent_number, layers)
+    file_ = get_layers_data(filename, data_dir, patent_number, layers, stream, cache, concurrency, compress, graph_dir)
     
-    data = json.load(open(file_))
+    with open_raw(file_) as f:
+        data = json.load(f)
     
     for layer in data:
-        data[layer]['inventors'] = pd.read_json(data[layer]['inventors'])
+        data[layer]['inventors'] = pd.read_json(io.StringIO(data[layer]['inventors']))
     
     return data
     
 
-def get_layers_data(filename, filepath, patent_number, layers):
+@metrics.timed('get_layers_data')
+def get_layers_data(filename, filepath, patent_number, layers, stream = False, cache = False, concurrency = None, compress = False, graph_dir = None):
     """
     Fetches all data, one layer at a time.
     If the data is not already on file, fetches data and saves it to filepath.
@@ -498,78 +1296,198 @@ def get_layers_data(filename, filepath, patent_number, layers):
     :filepath: string type, data folder path
     :patent_number: string type, format ['key1', 'key2', ...] or 'key1'
     :layers: int, number of layers for which to get data
+    :stream: if True, the saved raw json data is parsed incrementally (see preprocess_layer_data)
+    :cache: if True, the saved raw json data is read from the normalized tables cached next to it (see preprocess_layer_data)
+    :concurrency: (optional) int, if given the layers are fetched by the asyncio crawler, with at most concurrency batches
+                  in flight at a time, and patents already fetched for a previous layer are not queried again (see crawl_cited_patents_data)
+    :compress: if True, the raw data of each layer is saved as gzip compressed json lines (see storage.write_patents),
+               and the data for all layers is saved gzip compressed as well. Data already on file is used whichever its format
+    :graph_dir: (optional) string type, directory of the citation graph (see graph.py). When the layers are crawled,
+                the citations of all the crawled patents are added to the graph, so that the networks of other root patents
+                can be explored from it later on
     
     Outputs
     :file_: string type, full file path of the saved data
     """
-    if (filename[-5:] == '.json'):
-        filename = filename[:-5]
+    filename = strip_extension(filename)
     
-    filenames = [filename + '_layer' + str(q) + '.json' for q in range(layers)]
+    filenames = [filename + '_layer' + str(q) + ('.jsonl.gz' if compress else '.json') for q in range(layers)]
     output_data = {}
+    # records fetched by the crawler so far, format {patent_number : record}
+    records = {}
     
     for i,file_ in enumerate(filenames):
         print(filepath,file_)
-        if os.path.isfile(os.path.join(filepath,file_)):
-            datafile = os.path.join(filepath,file_)
+        if (find_raw_file(filepath, file_)):
+            datafile = find_raw_file(filepath, file_)
             print('already on file')
+            if (concurrency):
+                for patent in iter_patents(datafile, stream):
+                    if (patent != None) and ('patent_number' in patent):
+                        records[patent['patent_number']] = patent
+        elif (concurrency):
+            datafile = crawl_cited_patents_data(file_, filepath, patent_number, records, concurrency)
         else:
             datafile = get_cited_patents_data(file_, filepath, patent_number)
         
         # preprocess the data
-        cited_patents, inventors = preprocess_layer_data(datafile)
+        cited_patents, inventors = preprocess_layer_data(datafile, stream, cache)
         
         output_data[i] = {'cited_patents' : cited_patents,
                           'inventors' : inventors.to_json()}
         
         patent_number = cited_patents.copy()
+    
+    if (graph_dir) and (concurrency):
+        print('updating citation graph')
+        save_graph(update_graph(load_graph(graph_dir, mmap = False), records.values()), graph_dir)
         
     # save data for all layers in a single file
     print('saving data')
-    file_ = os.path.join(filepath,filename + '.json')
-    with open(file_, 'w') as f:
+    if (compress):
+        file_ = os.path.join(filepath,filename + '.json.gz')
+        f = gzip.open(file_, 'wt', encoding = 'utf-8')
+    else:
+        file_ = os.path.join(filepath,filename + '.json')
+        f = open(file_, 'w')
+    with f:
         json.dump(output_data, f,ensure_ascii=False)
         
     return file_
 
 
-def get_cited_patents_data(filename, filepath, patent_numbers):
+@metrics.timed('fetch_layer')
+def get_cited_patents_data(filename, filepath, patent_numbers, workers = 4):
     """
     Fetches the data for the given list of patent_numbers from the PatentsView API.
     
     Inputs
-    :filename: string type, data filename to save the data
+    :filename: string type, data filename to save the data. Data is saved as compressed json lines if it ends with '.jsonl.gz'
     :filepath: string type, data folder path to save the data
     :patent_numbers: list of patent numbers for which to query.
+    :workers: int, maximum number of batches of patent numbers fetched at the same time.
+              All requests share the same rate limit (see fetcher.fetch_page)
     
     Outputs
     :file_: string type, full file path of the saved data
     """
-    data = {}
+    batches = []
     i = 0
     # queries for a fixed number of patents at a time, to prevent errors
     while ((i+1)*100 < len(patent_numbers)):
-        datafile = patentsviewAPI('temp.json', filepath, patent_number = patent_numbers[i*100:(i+1)*100])
-        data[i] = json.load(open(datafile))
+        batches.append(patent_numbers[i*100:(i+1)*100])
         i += 1
+    batches.append(patent_numbers[i*100:])
+    
+    # the results are kept in memory, in the order of the batches
+    fetch_batch = lambda batch : fetch_query(*query_parts(patent_number = batch))
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        data = dict(enumerate(executor.map(fetch_batch, batches)))
+    
+    file_ = os.path.join(filepath,filename)
+    # save data to file_
+    if (file_.endswith('.jsonl.gz')):
+        write_patents(walk_patents(data), file_)
+    else:
+        with open(file_, 'w') as f:
+            json.dump(data, f)
+    
+    return file_
+
+
+def run_coroutine(coroutine):
+    """
+    Runs a coroutine to completion and returns its result, also when called from a running event loop (e.g. in Jupyter),
+    in which case the coroutine is run in its own event loop, in a worker thread
+    
+    Inputs
+    :coroutine: coroutine object
+    
+    Outputs
+    :result: value returned by the coroutine
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    
+    with ThreadPoolExecutor(max_workers = 1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
 
-    datafile = patentsviewAPI('temp.json', filepath, patent_number = patent_numbers[i*100:])
-    data[i] = json.load(open(datafile))
+@metrics.timed('fetch_layer')
+def crawl_cited_patents_data(filename, filepath, patent_numbers, records, concurrency = 8):
+    """
+    Fetches the data for the given list of patent_numbers from the PatentsView API, with an asyncio crawler,
+    and saves it in the same format as get_cited_patents_data().
+    Only the patent numbers which are not in records yet are queried, in batches fetched concurrently,
+    so that the patents already fetched for a previous layer are never queried again.
+    
+    Inputs
+    :filename: string type, data filename to save the data. Data is saved as compressed json lines if it ends with '.jsonl.gz'
+    :filepath: string type, data folder path to save the data
+    :patent_numbers: list of patent numbers for which to query.
+    :records: dictionary of the records fetched so far, format {patent_number : record}, 
+              updated in place, with None for the patent numbers which returned no results
+    :concurrency: int, maximum number of batches fetched at the same time (see fetcher.fetch_queries_async)
+    
+    Outputs
+    :file_: string type, full file path of the saved data
+    """
+    if isinstance(patent_numbers, str):
+        patent_numbers = [patent_numbers]
+    
+    # unique patent numbers, in the order of the list
+    patent_numbers = list(dict.fromkeys(patent_numbers))
+    new_numbers = [number for number in patent_numbers if number not in records]
+    print(len(patent_numbers) - len(new_numbers), 'patents already fetched,', len(new_numbers), 'to fetch')
+    
+    # queries for a fixed number of patents at a time, to prevent errors,
+    # and includes the patent number in the output fields to match the results with the queried numbers
+    batches = [new_numbers[i:i+100] for i in range(0, len(new_numbers), 100)]
+    queries = []
+    for batch in batches:
+        query_str, all_fields, options = query_parts(patent_number = batch)
+        queries.append((query_str, all_fields + ['patent_number'], options))
+    
+    results = run_coroutine(fetch_queries_async(queries, concurrency))
+    
+    for number in new_numbers:
+        records[number] = None
+    for data_list in results:
+        for patent in walk_patents(data_list):
+            if (patent != None):
+                records[patent['patent_number']] = patent
+    
+    # the results of each query are saved under its index, in the order returned by the API, as in get_cited_patents_data(),
+    # followed by the patents already fetched for a previous layer
+    data = dict(enumerate(results))
+    fetched = set(new_numbers)
+    patents = [records[number] for number in patent_numbers if (number not in fetched) and (records[number] != None)]
+    if (patents):
+        data[len(results)] = {1 : {'patents' : patents, 'count' : len(patents)}}
     
     file_ = os.path.join(filepath,filename)
     # save data to file_
-    with open(file_, 'w') as f:
-        json.dump(data, f)
+    if (file_.endswith('.jsonl.gz')):
+        write_patents(walk_patents(data), file_)
+    else:
+        with open(file_, 'w') as f:
+            json.dump(data, f)
     
     return file_
 
 
-def preprocess_layer_data(file_):
+@metrics.timed('preprocess_layer_data')
+def preprocess_layer_data(file_, stream = False, cache = False):
     """
     Preprocesses saved json data from file to the format used for the data analysis. (see Methodology notebook)
 
     Input
     :file_: path to file containing the json data, format
+    :stream: if True, the file is parsed incrementally, one patent record at a time, instead of being loaded whole
+    :cache: if True, the records are read from the normalized tables cached next to the file, reading only
+            the patent type, inventor and citation columns (see storage.load_tables)
 
     Output
     :cited_patent_list: list of cited patents in the data,
@@ -579,33 +1497,37 @@ def preprocess_layer_data(file_):
     inventor_key_id = []
     inventor_latitude = []
     inventor_longitude = []
+    seen_inventors = set()
     
-    json_data = json.load(open(file_))
+    if (cache):
+        patents = iter_cached_patents(load_tables(file_, stream), nested = ('inventors', 'citations'))
+    else:
+        patents = iter_patents(file_, stream)
     
-    for fold in json_data:
-
-        for page in json_data[fold]:
+    for patent in patents:
+        
+        if (patent == None):
+            print('error: empty page')
                 
-            for patent in json_data[fold][page]['patents']:
+        elif (patent['patent_type'] != 'reissue'):
+            
+            for inventor in patent['inventors']:
+                lat = inventor['inventor_latitude']
+                lon = inventor['inventor_longitude']
                 
-                if (patent['patent_type'] != 'reissue'):
-                    
-                    for inventor in patent['inventors']:
-                        lat = inventor['inventor_latitude']
-                        lon = inventor['inventor_longitude']
-                        
-                        # we only count each unique inventor once
-                        if (lat != '0.1') and (lat != None) and (inventor['inventor_key_id'] not in inventor_key_id) :
-                            inventor_key_id.append(inventor['inventor_key_id'])
-                            inventor_latitude.append(float(lat))
-                            inventor_longitude.append(float(lon))
-
-                    for cit_patent in patent['cited_patents']:
-                        cit_pat_num = cit_patent['cited_patent_number']
-                        if (cit_pat_num != None):
-                            cited_patent_list.append(cit_pat_num)
+                # we only count each unique inventor once
+                if (lat != '0.1') and (lat != None) and (inventor['inventor_key_id'] not in seen_inventors) :
+                    seen_inventors.add(inventor['inventor_key_id'])
+                    inventor_key_id.append(inventor['inventor_key_id'])
+                    inventor_latitude.append(float(lat))
+                    inventor_longitude.append(float(lon))
+
+            for cit_patent in patent['cited_patents']:
+                cit_pat_num = cit_patent['cited_patent_number']
+                if (cit_pat_num != None):
+                    cited_patent_list.append(cit_pat_num)
                                     
     inventor_info = pd.DataFrame(data = {'latitude' : inventor_latitude,
                                          'longitude' : inventor_longitude}, index = inventor_key_id)
  
-    return cited_patent_list, inventor_info
+    return cited_patent_list, inventor_info
\ No newline at end of file
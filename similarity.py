@@ -0,0 +1,327 @@
+""" network similarity functions """
+
+import numpy as np
+import pandas as pd
+
+"""
+FUNCTIONS TO COMPARE PATENT NETWORKS
+
+A network is the data returned by pipeline.load_layers_data(), format {layer : {'cited_patents' : [...], 'inventors' : ...}}.
+As in the original comparison, the patents of a network at a given layer are all the patents cited in that layer or any previous one.
+"""
+
+# number of set bits of each byte, to count the patents in packed bitmaps
+POPCOUNT = np.unpackbits(np.arange(256, dtype = np.uint8)[:, None], axis = 1).sum(axis = 1).astype(np.uint8)
+
+
+def layer_sets(layers_data, layers = None):
+    """
+    Returns the set of patents cited in each layer of a network, cumulated over the previous layers
+
+    Inputs
+    :layers_data: network, as returned by load_layers_data
+    :layers: (optional) list of the layers to return, all layers by default
+
+    Outputs
+    :sets: dictionary, format {layer : set of patent numbers}
+    """
+    if (layers == None):
+        layers = layers_data.keys()
+
+    sets = {}
+    cumulated = set()
+    for layer in layers:
+        cumulated = cumulated | set(layers_data[layer]['cited_patents'])
+        sets[layer] = cumulated
+
+    return sets
+
+
+def score(intersection, size1, size2, metric = 'overlap'):
+    """
+    Returns the similarity of two sets from their sizes. Empty sets have a similarity of nan.
+
+    Inputs
+    :intersection: int or numpy array, number of patents in both sets
+    :size*: int or numpy array, number of patents in each set
+    :metric: 'overlap' for |A & B| / min(|A|, |B|), which is the similarity of compute_similarities,
+             or 'jaccard' for |A & B| / |A | B|
+
+    Outputs
+    :similarity: float or numpy array
+    """
+    intersection = np.asarray(intersection, dtype = float)
+    if (metric == 'overlap'):
+        denominator = np.minimum(size1, size2)
+    elif (metric == 'jaccard'):
+        denominator = np.asarray(size1) + np.asarray(size2) - intersection
+    else:
+        raise ValueError('unknown metric ' + str(metric))
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return np.where(denominator > 0, intersection / np.maximum(denominator, 1), np.nan)
+
+
+def compare_networks(layers_data1, layers_data2):
+    """
+    Computes the similarity of the patents cited by two networks at each layer.
+    The layers compared are those of the network with fewer layers, or of the second network if both have as many.
+
+    Inputs
+    :layers_data*: networks to compare, as returned by load_layers_data
+
+    Outputs
+    :similarities: DataFrame indexed by layer, columns ['Similarity', 'Jaccard', 'Common']:
+                   overlap similarity (see score), jaccard similarity and number of patents cited by both networks
+    """
+    if len(layers_data1) < len(layers_data2):
+        layers_range = list(layers_data1.keys())
+    else:
+        layers_range = list(layers_data2.keys())
+
+    sets1 = layer_sets(layers_data1, layers_range)
+    sets2 = layer_sets(layers_data2, layers_range)
+
+    common = np.array([len(sets1[layer] & sets2[layer]) for layer in layers_range])
+    size1 = np.array([len(sets1[layer]) for layer in layers_range])
+    size2 = np.array([len(sets2[layer]) for layer in layers_range])
+
+    return pd.DataFrame({'Similarity' : score(common, size1, size2, 'overlap'),
+                         'Jaccard' : score(common, size1, size2, 'jaccard'),
+                         'Common' : common},
+                        index = layers_range)
+
+
+def to_bitmaps(sets):
+    """
+    Encodes sets of patent numbers as packed bitmaps over the union of all the sets:
+    bit j of row i is set if the j-th patent of the union is in the i-th set
+
+    Inputs
+    :sets: list of sets of patent numbers
+
+    Outputs
+    :bitmaps: numpy uint8 array, one row of packed bits per set
+    """
+    universe = {}
+    codes = [np.array([universe.setdefault(number, len(universe)) for number in set_], dtype = np.int64) for set_ in sets]
+
+    bitmaps = np.zeros((len(sets), (len(universe) + 7) // 8), dtype = np.uint8)
+    row = np.zeros(len(universe), dtype = bool)
+    for i, code in enumerate(codes):
+        row[:] = False
+        row[code] = True
+        bitmaps[i] = np.packbits(row)
+
+    return bitmaps
+
+
+def similarity_matrix(networks, layer, metric = 'overlap'):
+    """
+    Computes the similarity of every pair of networks at the given layer.
+    The networks are encoded as bitmaps (see to_bitmaps), so that the intersections of one network with all the others
+    are counted at once, with a bitwise and over the bitmaps.
+
+    Inputs
+    :networks: dictionary, format {name : network}, networks as returned by load_layers_data
+    :layer: layer at which to compare the networks, every network must have it
+    :metric: 'overlap' or 'jaccard' (see score)
+
+    Outputs
+    :similarities: DataFrame of the similarities, indexed by network name in both rows and columns
+    """
+    names = list(networks.keys())
+    sets = []
+    for name in names:
+        layers = list(networks[name].keys())
+        sets.append(layer_sets(networks[name], layers[:layers.index(layer) + 1])[layer])
+
+    bitmaps = to_bitmaps(sets)
+    sizes = POPCOUNT[bitmaps].sum(axis = 1, dtype = np.int64)
+
+    intersections = np.zeros((len(names), len(names)), dtype = np.int64)
+    for i in range(len(names)):
+        intersections[i] = POPCOUNT[bitmaps[i] & bitmaps].sum(axis = 1, dtype = np.int64)
+
+    return pd.DataFrame(score(intersections, sizes[:, None], sizes[None, :], metric), index = names, columns = names)
+
+
+"""
+FUNCTIONS TO SKETCH PATENT NETWORKS
+
+The MinHash signature of a set holds, for each of num_perm random hash functions, the smallest hash of the patents of the set.
+Two signatures agree on a given hash function with probability equal to the jaccard similarity J of the two sets,
+so the fraction of agreeing values is an unbiased estimate of J, with standard deviation sqrt(J * (1 - J) / num_perm),
+and by Hoeffding's inequality P(|estimate - J| >= eps) <= 2 * exp(-2 * num_perm * eps**2)
+(e.g. with 128 hash functions, the estimate is within 0.12 of J with probability at least 0.95).
+
+The LSH index splits the signatures in bands of rows values, and only compares a query with the signatures which are equal
+to it on at least one band: a network of jaccard similarity J to the query is a candidate with probability
+1 - (1 - J**rows)**bands (see lsh_probability), so that only the similar networks are compared, instead of all of them.
+"""
+
+def hash_functions(num_perm, seed = 0):
+    """
+    Draws the random hash functions of the MinHash signatures, h(x) = (a * x + b) mod 2**64, keeping the 32 high bits
+
+    Inputs
+    :num_perm: int, number of hash functions
+    :seed: int, seed of the random generator, signatures can only be compared if they have the same seed
+
+    Outputs
+    :a, b: numpy uint64 arrays, with odd values of a
+    """
+    generator = np.random.default_rng(seed)
+    a = generator.integers(0, 2**63, num_perm, dtype = np.uint64) * np.uint64(2) + np.uint64(1)
+    b = generator.integers(0, 2**63, num_perm, dtype = np.uint64)
+    return a, b
+
+
+def minhash_signature(patents, num_perm = 128, seed = 0):
+    """
+    Computes the MinHash signature of a set of patent numbers
+
+    Inputs
+    :patents: iterable of patent numbers
+    :num_perm: int, number of hash functions
+    :seed: int, seed of the hash functions (see hash_functions)
+
+    Outputs
+    :signature: numpy uint32 array of length num_perm, all values are 2**32 - 1 for an empty set
+    """
+    a, b = hash_functions(num_perm, seed)
+    signature = np.full(num_perm, 2**32 - 1, dtype = np.uint32)
+
+    patents = np.array(list(set(patents)), dtype = object)
+    if (len(patents) == 0):
+        return signature
+
+    # stable 64 bits hash of each patent number, unlike the builtin hash
+    hashes = pd.util.hash_array(patents)
+    for i in range(num_perm):
+        signature[i] = ((a[i] * hashes + b[i]) >> np.uint64(32)).min()
+
+    return signature
+
+
+def network_signatures(networks, num_perm = 128, seed = 0):
+    """
+    Computes the MinHash signature of each layer of each network, the patents of a layer being cumulated over the previous layers
+
+    Inputs
+    :networks: dictionary, format {name : network}, networks as returned by load_layers_data
+    :num_perm: int, number of hash functions
+    :seed: int, seed of the hash functions (see hash_functions)
+
+    Outputs
+    :signatures: dictionary, format {(name, layer) : signature}
+    """
+    signatures = {}
+    for name in networks:
+        sets = layer_sets(networks[name])
+        for layer in sets:
+            signatures[(name, layer)] = minhash_signature(sets[layer], num_perm, seed)
+
+    return signatures
+
+
+def estimate_jaccard(signature1, signature2):
+    """
+    Estimates the jaccard similarity of two sets from their MinHash signatures
+
+    Inputs
+    :signature*: as returned by minhash_signature, with the same num_perm and seed
+
+    Outputs
+    :jaccard: float, fraction of equal values in the signatures
+    """
+    return float(np.mean(signature1 == signature2))
+
+
+def lsh_probability(jaccard, bands, rows):
+    """
+    Returns the probability that a network of given jaccard similarity to the query is a candidate of the LSH index
+
+    Inputs
+    :jaccard: float or numpy array
+    :bands, rows: int, as used by build_lsh_index
+
+    Outputs
+    :probability: float or numpy array
+    """
+    return 1 - (1 - np.asarray(jaccard, dtype = float)**rows)**bands
+
+
+def build_lsh_index(signatures, bands = 32):
+    """
+    Builds an LSH index over MinHash signatures
+
+    Inputs
+    :signatures: dictionary, format {key : signature}, as returned by network_signatures
+    :bands: int, number of bands, must divide the length of the signatures.
+            More bands find networks of lower similarity, at the cost of more candidates
+
+    Outputs
+    :index: dictionary, format {'bands', 'rows', 'buckets', 'signatures'},
+            buckets is a list with, for each band, a dictionary of the keys of the signatures by value of the band
+    """
+    num_perm = len(next(iter(signatures.values())))
+    if (num_perm % bands != 0):
+        raise ValueError('the number of bands must divide the length of the signatures')
+    rows = num_perm // bands
+
+    buckets = [{} for band in range(bands)]
+    for key in signatures:
+        for band in range(bands):
+            value = signatures[key][band*rows:(band+1)*rows].tobytes()
+            buckets[band].setdefault(value, []).append(key)
+
+    return {'bands' : bands, 'rows' : rows, 'buckets' : buckets, 'signatures' : signatures}
+
+
+def query_lsh_index(index, signature, top = 10):
+    """
+    Returns the networks most similar to a query network, among the candidates of the LSH index
+
+    Inputs
+    :index: as returned by build_lsh_index
+    :signature: MinHash signature of the query, as returned by minhash_signature
+    :top: int, maximum number of networks to return
+
+    Outputs
+    :similar: list of (key, estimated jaccard similarity), from the most to the least similar
+    """
+    rows = index['rows']
+    candidates = set()
+    for band in range(index['bands']):
+        value = signature[band*rows:(band+1)*rows].tobytes()
+        candidates.update(index['buckets'][band].get(value, []))
+
+    similar = [(key, estimate_jaccard(signature, index['signatures'][key])) for key in candidates]
+    similar.sort(key = lambda item : item[1], reverse = True)
+
+    return similar[:top]
+
+
+def minhash_error(networks, layer, num_perm = 128, seed = 0):
+    """
+    Compares the jaccard similarities estimated from the MinHash signatures with the exact ones (see similarity_matrix)
+
+    Inputs
+    :networks: dictionary, format {name : network}, networks as returned by load_layers_data
+    :layer: layer at which to compare the networks, every network must have it
+    :num_perm: int, number of hash functions
+    :seed: int, seed of the hash functions (see hash_functions)
+
+    Outputs
+    :errors: DataFrame of the absolute errors of the estimates, indexed by network name in both rows and columns
+    :bound: float, error exceeded with probability at most 0.05 by each estimate, from Hoeffding's inequality
+    """
+    exact = similarity_matrix(networks, layer, 'jaccard')
+    signatures = network_signatures(networks, num_perm, seed)
+
+    names = list(networks.keys())
+    estimates = pd.DataFrame([[estimate_jaccard(signatures[(name1, layer)], signatures[(name2, layer)]) for name2 in names] for name1 in names],
+                             index = names, columns = names)
+
+    return (estimates - exact).abs(), float(np.sqrt(np.log(2 / 0.05) / (2 * num_perm)))
@@ -0,0 +1,472 @@
+""" local stand-in of the PatentsView API """
+
+import argparse
+import collections
+import datetime
+import json
+import math
+import random
+import socket
+import struct
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from fetcher import TokenBucket, REQUESTS_PER_MINUTE, PER_PAGE, MAX_RESULTS
+from storage import iter_patents
+from benchmarks import make_patent
+
+"""
+FUNCTIONS TO LOAD THE DATA SERVED
+
+The stand-in serves patent records in the format of the PatentsView API, either read from raw data files
+saved by get_data() (fixtures), or synthetic (see benchmarks.make_patent).
+Date queries are answered from the 'applications' field of the records, format [{'app_date' : 'YYYY-MM-DD'}].
+"""
+
+def random_date(generator, year):
+    """
+    Returns a random date of the given year
+
+    Inputs
+    :generator: random.Random instance
+    :year: int
+
+    Outputs
+    :date: string type, format 'YYYY-MM-DD'
+    """
+    first = datetime.date(year, 1, 1)
+    days = (datetime.date(year + 1, 1, 1) - first).days
+    return (first + datetime.timedelta(days = generator.randrange(days))).isoformat()
+
+
+def synthetic_patents(num_patents, year, seed = 0):
+    """
+    Returns synthetic patent records, applied for at random dates of the given year
+
+    Inputs
+    :num_patents: int, number of patents
+    :year: int, year of the application dates
+    :seed: int, seed of the random generator, the same seed always gives the same records
+
+    Outputs
+    :patents: list of patent records
+    """
+    generator = random.Random(seed)
+    return [make_patent(generator, number, num_patents, year) for number in range(num_patents)]
+
+
+def load_fixtures(files, year = None, seed = 0):
+    """
+    Returns the patent records of raw data files saved by get_data()
+
+    Inputs
+    :files: list of string type, paths of the raw data files
+    :year: (optional) int, if given, the records without an application date (e.g. fetched without the 'app_date' field)
+           are given a random date of that year, so that they can be found by date queries
+    :seed: int, seed of the random dates
+
+    Outputs
+    :patents: list of patent records, without duplicates
+    """
+    generator = random.Random(seed)
+    patents = {}
+    for file_ in files:
+        for patent in iter_patents(file_):
+            if (patent == None) or ('patent_number' not in patent):
+                continue
+            if (year != None) and not any(application.get('app_date') for application in (patent.get('applications') or [])):
+                patent['applications'] = [{'app_date' : random_date(generator, year)}]
+            patents[patent['patent_number']] = patent
+
+    return list(patents.values())
+
+
+"""
+FUNCTIONS TO ANSWER QUERIES
+
+Only the parts of the PatentsView query language used by the pipeline are supported:
+the _and, _or and _not operators, the _eq, _neq, _gt, _gte, _lt and _lte comparisons,
+and the equality with a value or a list of values, e.g. {'patent_number' : ['key1', 'key2']}.
+A criterion on a field of a nested entity (e.g. app_date) matches if any of the entities of the patent matches.
+"""
+
+COMPARISONS = {'_eq' : lambda value, operand : value == operand,
+               '_neq' : lambda value, operand : value != operand,
+               '_gt' : lambda value, operand : value > operand,
+               '_gte' : lambda value, operand : value >= operand,
+               '_lt' : lambda value, operand : value < operand,
+               '_lte' : lambda value, operand : value <= operand}
+
+# as in the API, the key id of an entity is always returned along with the other requested fields of its group
+KEY_FIELDS = {'inventors' : 'inventor_key_id', 'assignees' : 'assignee_key_id'}
+
+
+def patent_sort_key(patent):
+    """
+    Returns the sort key of a patent record: the API returns the patents by patent number
+    """
+    number = patent['patent_number']
+    return (len(number), number)
+
+
+def field_values(patent, field):
+    """
+    Returns the values of a field in a patent record, either a field of the patent or of its nested entities
+
+    Inputs
+    :patent: dictionary, patent record
+    :field: string type, name of the field
+
+    Outputs
+    :values: list of the values which are not None
+    """
+    if (field in patent):
+        values = [patent[field]]
+    else:
+        values = [item.get(field) for value in patent.values() if isinstance(value, list) for item in value if isinstance(item, dict)]
+
+    return [value for value in values if value != None]
+
+
+def matches(patent, criteria):
+    """
+    Returns whether a patent record matches query filters
+
+    Inputs
+    :patent: dictionary, patent record
+    :criteria: dictionary, query filters as returned by pipeline.query()
+
+    Outputs
+    :match: bool
+    """
+    for key, value in criteria.items():
+        if (key == '_and'):
+            match = all(matches(patent, criterion) for criterion in value)
+        elif (key == '_or'):
+            match = any(matches(patent, criterion) for criterion in value)
+        elif (key == '_not'):
+            match = not matches(patent, value)
+        elif (key in COMPARISONS):
+            match = all(any(COMPARISONS[key](field_value, operand) for field_value in field_values(patent, field))
+                        for field, operand in value.items())
+        elif (key.startswith('_')):
+            raise ValueError('unsupported operator ' + key)
+        else:
+            operands = value if isinstance(value, list) else [value]
+            match = any(field_value in operands for field_value in field_values(patent, key))
+        if not (match):
+            return False
+
+    return True
+
+
+def select_fields(patent, fields, groups):
+    """
+    Returns a patent record with only the requested output fields.
+    As in the API, an entity group is returned with None values when the patent has no entity of that group,
+    and with the key id of its entities (see KEY_FIELDS) whenever one of its fields is requested.
+
+    Inputs
+    :patent: dictionary, patent record
+    :fields: set of the requested output fields
+    :groups: dictionary, format {group : set of the fields of its entities}, e.g. {'cited_patents' : {'cited_patent_number'}}
+
+    Outputs
+    :patent: dictionary, new patent record
+    """
+    output = {}
+    for key, value in patent.items():
+        if (key in groups):
+            group_fields = [field for field in groups[key] if field in fields]
+            if (group_fields) and (key in KEY_FIELDS) and (KEY_FIELDS[key] not in group_fields):
+                group_fields.insert(0, KEY_FIELDS[key])
+            if (group_fields):
+                output[key] = [{field : item.get(field) for field in group_fields} for item in value] or [{field : None for field in group_fields}]
+        elif (key in fields):
+            output[key] = value
+
+    return output
+
+
+def make_standin(patents, rate = REQUESTS_PER_MINUTE, capacity = 5, reset_rate = 0, latency = 0, max_results = MAX_RESULTS, seed = 0):
+    """
+    Creates the state of a stand-in API serving the given patent records
+
+    Inputs
+    :patents: list of patent records, as returned by synthetic_patents() or load_fixtures()
+    :rate: float, requests per minute allowed before answering 429, 0 for no limit
+    :capacity: int, number of requests which can be sent at once after a pause (see fetcher.TokenBucket)
+    :reset_rate: float, fraction of the requests whose connection is reset instead of being answered
+    :latency: float, time in seconds taken to answer each request
+    :max_results: int, number of results of a query which can be reached through the pages
+    :seed: int, seed of the random connection resets
+
+    Outputs
+    :standin: dictionary, to pass into answer_query() and start_server()
+    """
+    groups = collections.defaultdict(set)
+    for patent in patents:
+        for key, value in patent.items():
+            if isinstance(value, list):
+                for item in value:
+                    groups[key].update(item.keys())
+
+    standin = {'patents' : sorted(patents, key = patent_sort_key),
+               'index' : {patent['patent_number'] : patent for patent in patents},
+               'groups' : dict(groups),
+               'limiter' : TokenBucket(rate / 60, capacity) if (rate) else None,
+               'reset_rate' : reset_rate,
+               'latency' : latency,
+               'max_results' : max_results,
+               'random' : random.Random(seed),
+               # results of the latest queries, so that the patents are only filtered once for all the pages of a query
+               'results' : collections.OrderedDict(),
+               'lock' : threading.Lock(),
+               'stats' : collections.Counter()}
+
+    return standin
+
+
+def query_results(standin, query_str):
+    """
+    Returns all the patent records matching query filters, in order of patent number
+
+    Inputs
+    :standin: as returned by make_standin()
+    :query_str: dictionary, query filters as returned by pipeline.query()
+
+    Outputs
+    :results: list of patent records
+    """
+    key = json.dumps(query_str, sort_keys = True)
+    with standin['lock']:
+        if (key in standin['results']):
+            standin['results'].move_to_end(key)
+            return standin['results'][key]
+
+    # queries of patent numbers are answered from the index, without going through all the patents
+    if (list(query_str.keys()) == ['patent_number']):
+        numbers = query_str['patent_number'] if isinstance(query_str['patent_number'], list) else [query_str['patent_number']]
+        results = sorted([standin['index'][number] for number in set(numbers) if number in standin['index']], key = patent_sort_key)
+    else:
+        results = [patent for patent in standin['patents'] if matches(patent, query_str)]
+
+    with standin['lock']:
+        standin['results'][key] = results
+        if (len(standin['results']) > 16):
+            standin['results'].popitem(last = False)
+
+    return results
+
+
+def answer_query(standin, query_str, fields_str, options):
+    """
+    Answers a query as the PatentsView API would
+
+    Inputs
+    :standin: as returned by make_standin()
+    :query_str: dictionary, query filters
+    :fields_str: list of output fields, format ['field1', 'field2', ...]
+    :options: dictionary, output options, format {'page' : ..., 'per_page' : ...}
+
+    Outputs
+    :data: dictionary, format {'patents' : [...], 'count' : ..., 'total_patent_count' : ...},
+           patents is None when the page is empty
+    """
+    results = query_results(standin, query_str)
+    page = int(options.get('page', 1))
+    per_page = min(int(options.get('per_page', 25)), PER_PAGE)
+
+    # the results past max_results cannot be reached, whichever the page
+    reachable = results[:standin['max_results']]
+    patents = [select_fields(patent, set(fields_str), standin['groups']) for patent in reachable[(page - 1) * per_page:page * per_page]]
+
+    return {'patents' : patents or None, 'count' : len(patents), 'total_patent_count' : len(results)}
+
+
+"""
+FUNCTIONS TO SERVE THE STAND-IN
+"""
+
+class StandinHandler(BaseHTTPRequestHandler):
+    """
+    Answers the q / f / o queries sent by GET or POST, as the PatentsView API, and the statistics of the stand-in at /stats
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data, headers = {}):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for header in headers:
+            self.send_header(header, headers[header])
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reset_connection(self):
+        # closing with a zero linger time sends a TCP reset instead of a normal close
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        self.connection.close()
+        self.close_connection = True
+
+    def answer(self, parts):
+        standin = self.server.standin
+        with standin['lock']:
+            standin['stats']['requests'] += 1
+            reset = standin['random'].random() < standin['reset_rate']
+
+        if (standin['limiter'] != None):
+            wait = standin['limiter'].try_acquire()
+            if (wait > 0):
+                with standin['lock']:
+                    standin['stats']['rate_limited'] += 1
+                self.send_json(429, {'error' : 'too many requests'}, {'Retry-After' : str(math.ceil(wait))})
+                return
+
+        if (reset):
+            with standin['lock']:
+                standin['stats']['resets'] += 1
+            self.reset_connection()
+            return
+
+        time.sleep(standin['latency'])
+        try:
+            data = answer_query(standin, parts['q'], parts.get('f', ['patent_number']), parts.get('o', {}))
+        except (ValueError, TypeError, AttributeError, KeyError) as error:
+            self.send_json(400, {'error' : str(error)}, {'X-Status-Reason' : str(error)})
+            return
+
+        with standin['lock']:
+            standin['stats']['pages'] += 1
+            standin['stats']['patents'] += data['count']
+        self.send_json(200, data)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if (url.path == '/stats'):
+            with self.server.standin['lock']:
+                self.send_json(200, dict(self.server.standin['stats']))
+            return
+
+        try:
+            parts = {name : json.loads(values[0]) for name, values in parse_qs(url.query).items() if name in ['q', 'f', 'o']}
+        except ValueError as error:
+            self.send_json(400, {'error' : str(error)}, {'X-Status-Reason' : str(error)})
+            return
+        if ('q' not in parts):
+            self.send_json(400, {'error' : 'missing query'}, {'X-Status-Reason' : 'missing query'})
+            return
+        self.answer(parts)
+
+    def do_POST(self):
+        try:
+            parts = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        except ValueError as error:
+            self.send_json(400, {'error' : str(error)}, {'X-Status-Reason' : str(error)})
+            return
+        if not isinstance(parts, dict) or ('q' not in parts):
+            self.send_json(400, {'error' : 'missing query'}, {'X-Status-Reason' : 'missing query'})
+            return
+        self.answer(parts)
+
+
+def start_server(standin, host = '127.0.0.1', port = 0):
+    """
+    Serves a stand-in API from a background thread
+
+    Inputs
+    :standin: as returned by make_standin()
+    :host: string type, address to listen on
+    :port: int, port to listen on, 0 for any free port
+
+    Outputs
+    :server: ThreadingHTTPServer, stopped with server.shutdown()
+    :url: string type, url of the query endpoint, to pass as the url of the fetcher functions or as PATENTSVIEW_API_URL
+    """
+    server = ThreadingHTTPServer((host, port), StandinHandler)
+    server.daemon_threads = True
+    server.standin = standin
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+
+    return server, 'http://{}:{}/api/patents/query'.format(host, server.server_address[1])
+
+
+def smoke_test(num_patents = 2000, year = 2015, data_dir = None):
+    """
+    Fetches a full year of synthetic patents from a stand-in and preprocesses it, with
+    pipeline.get_full_year_data() and pipeline.load_data(), to check that the pipeline runs end to end against the stand-in
+
+    Inputs
+    :num_patents: int, number of synthetic patents to serve
+    :year: int, year of the application dates
+    :data_dir: (optional) string type, directory to save the fetched data to, a temporary directory by default
+
+    Outputs
+    :full_year_data: preprocessed data of the year, as returned by pipeline.load_data()
+    """
+    import tempfile
+    import fetcher
+    import pipeline
+
+    standin = make_standin(synthetic_patents(num_patents, year), rate = 0)
+    server, url = start_server(standin)
+    api_url = fetcher.API_URL
+    fetcher.API_URL = url
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            full_year_data = pipeline.load_data(range(year, year + 1), data_dir or temp_dir)
+    finally:
+        fetcher.API_URL = api_url
+        server.shutdown()
+
+    output = full_year_data[str(year)]
+    if (standin['stats']['patents'] != num_patents) or (output['num_inventors'] == 0) or (len(output['assignees']) == 0):
+        raise RuntimeError('smoke test failed: {} patents fetched out of {}, {} inventors, {} assignees'.format(
+                           standin['stats']['patents'], num_patents, output['num_inventors'], len(output['assignees'])))
+    print('smoke test passed:', num_patents, 'patents fetched and preprocessed')
+
+    return full_year_data
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Serves a local stand-in of the PatentsView API')
+    parser.add_argument('--fixtures', nargs = '+', help = 'raw data files saved by get_data to serve')
+    parser.add_argument('--synthetic', type = int, default = 100000, help = 'number of synthetic patents to serve, when there are no fixtures')
+    parser.add_argument('--year', type = int, default = 2015, help = 'year of the application dates of the synthetic patents, or of the fixtures without any')
+    parser.add_argument('--host', default = '127.0.0.1', help = 'address to listen on')
+    parser.add_argument('--port', type = int, default = 8000, help = 'port to listen on')
+    parser.add_argument('--rate', type = float, default = REQUESTS_PER_MINUTE, help = 'requests per minute allowed before answering 429, 0 for no limit')
+    parser.add_argument('--reset-rate', type = float, default = 0, help = 'fraction of the requests whose connection is reset')
+    parser.add_argument('--latency', type = float, default = 0, help = 'time in seconds taken to answer each request')
+    parser.add_argument('--max-results', type = int, default = MAX_RESULTS, help = 'number of results of a query which can be reached through the pages')
+    parser.add_argument('--seed', type = int, default = 0, help = 'seed of the synthetic data and of the connection resets')
+    parser.add_argument('--smoke', action = 'store_true', help = 'only run the pipeline once against a stand-in of --synthetic patents (see smoke_test)')
+    args = parser.parse_args()
+
+    if (args.smoke):
+        smoke_test(args.synthetic, args.year)
+        return
+
+    if (args.fixtures):
+        patents = load_fixtures(args.fixtures, args.year, args.seed)
+    else:
+        patents = synthetic_patents(args.synthetic, args.year, args.seed)
+
+    standin = make_standin(patents, args.rate, reset_rate = args.reset_rate, latency = args.latency, max_results = args.max_results, seed = args.seed)
+    server, url = start_server(standin, args.host, args.port)
+    print('serving', len(patents), 'patents, set PATENTSVIEW_API_URL=' + url)
+
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,431 @@
+""" raw data storage functions """
+
+import gzip
+import json
+import os
+import re
+import numpy as np
+import pandas as pd
+import metrics
+
+"""
+FUNCTIONS TO READ RAW DATA
+"""
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class JsonStream:
+    """
+    Incremental reader over a json text file, which only keeps the part of the file that has not been parsed yet in memory.
+    Values are decoded one at a time with json.JSONDecoder.raw_decode(), reading more of the file until they are complete.
+    """
+
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.text = ''
+        self.pos = 0
+        self.eof = False
+
+    def read(self):
+        chunk = self.f.read(self.chunk_size)
+        if (chunk):
+            # drop the text which has already been parsed
+            self.text = self.text[self.pos:] + chunk
+            self.pos = 0
+        else:
+            self.eof = True
+
+    def peek(self):
+        self.pos = WHITESPACE.match(self.text, self.pos).end()
+        while (self.pos >= len(self.text)) and not (self.eof):
+            self.read()
+            self.pos = WHITESPACE.match(self.text, self.pos).end()
+
+        if (self.pos < len(self.text)):
+            return self.text[self.pos]
+        return ''
+
+    def next(self):
+        c = self.peek()
+        self.pos += 1
+        return c
+
+    def expect(self, c):
+        if (self.next() != c):
+            raise ValueError('malformed json data, expected ' + c)
+
+    def decode(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.text, self.pos)
+            except json.JSONDecodeError:
+                if (self.eof):
+                    raise
+                self.read()
+                continue
+            # a number or a literal can be cut at the end of the chunk
+            if (end == len(self.text)) and not (self.eof):
+                self.read()
+                continue
+            self.pos = end
+            return value
+
+    def walk_object(self):
+        # the opening '{' has already been consumed
+        while True:
+            c = self.peek()
+            if (c == '}'):
+                self.next()
+                return
+            if (c == ','):
+                self.next()
+                continue
+
+            key = self.decode()
+            self.expect(':')
+            c = self.peek()
+
+            if (key == 'patents') and (c == '['):
+                self.next()
+                yield from self.walk_array()
+            elif (key == 'patents'):
+                # when query limit is reached, the results are empty pages
+                if (self.decode() == None):
+                    yield None
+            elif (c == '{'):
+                self.next()
+                yield from self.walk_object()
+            else:
+                self.decode()
+
+    def walk_array(self):
+        # the opening '[' has already been consumed
+        while True:
+            c = self.peek()
+            if (c == ']'):
+                self.next()
+                return
+            if (c == ','):
+                self.next()
+                continue
+            yield self.decode()
+
+
+def walk_patents(json_data):
+    """
+    Walks the 'patents' lists of raw data which has already been loaded in memory
+
+    Inputs
+    :json_data: dictionary, pages of data as saved by get_data(), or folds of pages as saved by get_cited_patents_data()
+
+    Outputs
+    :patent: generator of patent records, None for each empty page
+    """
+    if ('patents' in json_data):
+        if (json_data['patents'] != None):
+            yield from json_data['patents']
+        else:
+            yield None
+        return
+
+    for key in json_data:
+        if isinstance(json_data[key], dict):
+            yield from walk_patents(json_data[key])
+
+
+def open_raw(file_):
+    """
+    Opens a raw data file for reading, decompressing it transparently when it is gzip compressed
+    
+    Inputs
+    :file_: string type, path to the file
+    
+    Outputs
+    :f: text file object
+    """
+    with open(file_, 'rb') as f:
+        compressed = (f.read(2) == b'\x1f\x8b')
+    
+    if (compressed):
+        return gzip.open(file_, 'rt', encoding = 'utf-8')
+    return open(file_, encoding = 'utf-8')
+
+
+def iter_patents(file_, stream = False, chunk_size = 2**16):
+    """
+    Returns the patent records of a raw data file one at a time, in the order they were saved.
+    Works both for the files saved by get_data() and by get_cited_patents_data(), in json format,
+    or in json lines format with one patent per line (see write_patents), compressed or not.
+
+    Inputs
+    :file_: string type, path to the file containing the json data
+    :stream: if True, the file is parsed incrementally, so that only one record is held in memory at a time,
+             otherwise the whole file is loaded with json.load. Json lines files are always read one line at a time
+    :chunk_size: int, number of characters read from the file at a time when streaming
+
+    Outputs
+    :patent: generator of patent records, None for each empty page
+    """
+    metrics.count('bytes_read', os.path.getsize(file_))
+    
+    with open_raw(file_) as f:
+        if (file_.endswith('.jsonl')) or (file_.endswith('.jsonl.gz')):
+            for line in f:
+                yield json.loads(line)
+        elif (stream):
+            json_stream = JsonStream(f, chunk_size)
+            json_stream.expect('{')
+            yield from json_stream.walk_object()
+        else:
+            with metrics.timer('parse'):
+                json_data = json.load(f)
+            yield from walk_patents(json_data)
+
+
+"""
+FUNCTIONS TO WRITE RAW DATA
+"""
+
+# extensions of the raw data files, from the most to the least specific
+RAW_EXTENSIONS = ['.jsonl.gz', '.jsonl', '.json.gz', '.json']
+
+
+def strip_extension(file_):
+    """
+    Returns the path of a raw data file without its extension (see RAW_EXTENSIONS).
+    Other names are returned unchanged, since they may contain dots, e.g. 'U.S. Philips'
+    
+    Inputs
+    :file_: string type, path to the raw data file
+    
+    Outputs
+    :name: string type, path without extension
+    """
+    for extension in RAW_EXTENSIONS:
+        if (file_.endswith(extension)):
+            return file_[:-len(extension)]
+    return file_
+
+
+def find_raw_file(filepath, filename):
+    """
+    Returns the path of a raw data file which is already on file, in any of the raw data formats
+    
+    Inputs
+    :filepath: string type, data folder path
+    :filename: string type, data filename, with or without extension
+    
+    Outputs
+    :file_: string type, path to the existing file, None if there is none
+    """
+    name = os.path.join(filepath, strip_extension(filename))
+    for extension in RAW_EXTENSIONS:
+        if os.path.isfile(name + extension):
+            return name + extension
+    return None
+
+
+def write_patents(patents, file_):
+    """
+    Saves patent records to a gzip compressed json lines file, with one patent per line, and a line 'null' for each empty page
+    
+    Inputs
+    :patents: iterable of patent records, as returned by iter_patents()
+    :file_: string type, path of the file, should end with '.jsonl.gz'
+    
+    Outputs
+    :file_: string type, path of the saved file
+    """
+    # write to a temporary file first, so that an interrupted run does not leave a truncated file behind
+    with gzip.open(file_ + '.tmp', 'wt', encoding = 'utf-8', compresslevel = 6) as f:
+        for patent in patents:
+            f.write(json.dumps(patent) + '\n')
+    os.replace(file_ + '.tmp', file_)
+    
+    return file_
+
+
+"""
+FUNCTIONS TO CACHE NORMALIZED DATA
+"""
+
+# version of the layout of the cached tables, to invalidate the caches written by older versions
+CACHE_VERSION = 1
+
+# columns of the normalized tables, format {table : [column, ...]}
+# every row of the inventors, assignees and citations tables refers to its row in the patents table in the 'patent' column
+TABLES = {'patents' : ['patent_number', 'patent_type'],
+          'inventors' : ['patent', 'inventor_key_id', 'inventor_latitude', 'inventor_longitude'],
+          'assignees' : ['patent', 'assignee_key_id', 'assignee_organization', 'assignee_type'],
+          'citations' : ['patent', 'cited_patent_number']}
+
+# nested list of each patent record holding the rows of the tables above
+NESTED = {'inventors' : 'inventors',
+          'assignees' : 'assignees',
+          'citations' : 'cited_patents'}
+
+
+def source_stamp(file_):
+    """
+    Returns the stamp of a raw data file stored with the data cached from it, to detect when the file changes
+    
+    Inputs
+    :file_: string type, path to the raw data file
+    
+    Outputs
+    :stamp: list, [cache version, modification time in ns, size in bytes]
+    """
+    stat = os.stat(file_)
+    return [CACHE_VERSION, stat.st_mtime_ns, stat.st_size]
+
+
+def cache_file(file_):
+    """
+    Returns the path of the cached tables of a raw data file, saved next to it
+    
+    Inputs
+    :file_: string type, path to the raw data file
+    
+    Outputs
+    :cache_: string type, path to the cache file
+    """
+    return strip_extension(file_) + '.npz'
+
+
+def normalize_patents(patents):
+    """
+    Flattens patent records to columnar tables: patents, inventors, assignees and citations (see TABLES).
+    String columns are dictionary encoded: the distinct values of the column are stored once, and each row
+    stores the position of its value, or -1 for missing values.
+    
+    Inputs
+    :patents: iterable of patent records, as returned by iter_patents()
+    
+    Outputs
+    :arrays: dictionary of numpy arrays, format {'table.column.codes' : ..., 'table.column.values' : ...}
+    """
+    columns = {table + '.' + column : [] for table in TABLES for column in TABLES[table]}
+    empty_pages = 0
+    
+    for patent in patents:
+        if (patent == None):
+            empty_pages += 1
+            continue
+        
+        row = len(columns['patents.patent_type'])
+        columns['patents.patent_number'].append(patent.get('patent_number'))
+        columns['patents.patent_type'].append(patent['patent_type'])
+        
+        for table in NESTED:
+            for item in (patent.get(NESTED[table]) or []):
+                columns[table + '.patent'].append(row)
+                for column in TABLES[table][1:]:
+                    columns[table + '.' + column].append(item.get(column))
+    
+    arrays = {'empty_pages' : np.array(empty_pages)}
+    for name in columns:
+        if (name.endswith('.patent')):
+            arrays[name] = np.array(columns[name], dtype = np.int64)
+        else:
+            codes, values = pd.factorize(pd.Series(columns[name], dtype = object))
+            arrays[name + '.codes'] = codes.astype(np.int32)
+            arrays[name + '.values'] = np.array([str(value) for value in values], dtype = str)
+    
+    return arrays
+
+
+def load_tables(file_, stream = False):
+    """
+    Returns the normalized tables of a raw data file.
+    The tables are cached next to the raw data file, and normalized again whenever the raw data file has been modified since.
+    Columns are only read from disk when they are accessed, see read_column().
+    
+    Inputs
+    :file_: string type, path to the raw data file
+    :stream: if True, the raw data file is parsed incrementally when it needs to be normalized (see iter_patents)
+    
+    Outputs
+    :tables: numpy NpzFile, lazily loaded columns of the normalized tables
+    """
+    cache_ = cache_file(file_)
+    source = np.array(source_stamp(file_), dtype = np.int64)
+    
+    if os.path.isfile(cache_):
+        tables = np.load(cache_)
+        if ('source' in tables.files) and (np.array_equal(tables['source'], source)):
+            return tables
+        tables.close()
+    
+    print('normalizing', file_)
+    with metrics.timer('normalize'):
+        arrays = normalize_patents(iter_patents(file_, stream))
+        arrays['source'] = source
+        
+        # write to a temporary file first, so that an interrupted run does not leave a corrupted cache behind
+        with open(cache_ + '.tmp', 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(cache_ + '.tmp', cache_)
+    
+    return np.load(cache_)
+
+
+def read_column(tables, name, decode = True):
+    """
+    Reads a single column of the normalized tables
+    
+    Inputs
+    :tables: as returned by load_tables()
+    :name: string type, format 'table.column'
+    :decode: if False, string columns are returned dictionary encoded, as (codes, values)
+    
+    Outputs
+    :column: numpy array, with None for missing values in string columns
+    """
+    if (name + '.codes' not in tables.files):
+        return tables[name]
+    
+    codes = tables[name + '.codes']
+    values = tables[name + '.values']
+    if not (decode):
+        return codes, values
+    
+    # code -1 picks the None appended at the end
+    return np.append(values.astype(object), None)[codes]
+
+
+def iter_cached_patents(tables, nested = ('inventors', 'assignees', 'citations')):
+    """
+    Rebuilds the patent records from the normalized tables, in the same format as iter_patents(),
+    reading only the columns of the requested nested lists.
+    
+    Inputs
+    :tables: as returned by load_tables()
+    :nested: tables to include in the patent records, among 'inventors', 'assignees' and 'citations'
+    
+    Outputs
+    :patent: generator of patent records, None for each empty page
+    """
+    patent_type = read_column(tables, 'patents.patent_type').tolist()
+    
+    rows = {}
+    for table in nested:
+        patent_rows = read_column(tables, table + '.patent')
+        # rows of the table are sorted by patent, offsets[i]:offsets[i+1] are the rows of the i-th patent
+        offsets = np.searchsorted(patent_rows, np.arange(len(patent_type) + 1)).tolist()
+        columns = TABLES[table][1:]
+        values = list(zip(*[read_column(tables, table + '.' + column).tolist() for column in columns]))
+        rows[table] = (offsets, columns, values)
+    
+    for i in range(len(patent_type)):
+        patent = {'patent_type' : patent_type[i]}
+        for table in rows:
+            offsets, columns, values = rows[table]
+            patent[NESTED[table]] = [dict(zip(columns, value)) for value in values[offsets[i]:offsets[i+1]]]
+        yield patent
+    
+    for i in range(int(tables['empty_pages'])):
+        yield None
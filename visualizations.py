@@ -1,12 +1,14 @@
 """ data visualization functions """
 import folium
 import numpy as np
-import pandas as pd
 import matplotlib.pyplot as plt
 
 from matplotlib import gridspec
+from concurrent.futures import ProcessPoolExecutor
 from folium import plugins
-from pipeline import get_ts, get_all_locations, get_top_k_locations, get_assignee_ts
+from pipeline import get_ts, get_metrics_table, get_all_locations, get_top_k_locations, get_assignee_ts, get_assignee_table, bin_locations
+from similarity import compare_networks
+import metrics
 
 
 """
@@ -15,48 +17,40 @@ FUNCTIONS TO PRODUCE VISUALIZATIONS
 FUNCTIONS FOR PART 1
 """
 
-def get_html(full_year_data, viz, year, k = None, zoom_on = None) :
+# heat map options of the maps of Part 1
+HEATMAP_OPTIONS = {'blur' : 5, 'radius' : 5, 'min_opacity' : 0.2, 'max_val' : 1}
+MAX_ZOOM = 5
+
+
+def get_map_locations(full_year_data, viz, year, k = None, binned = False):
     """
-    Produce HTML rendering of Folium map
+    Computes the locations to draw on the map of the inventors, for the given type of assignees and year (see get_html)
     
     Inputs
     :full_year_data: required data for plotting the map
     :viz: string format, whether to include All, US, or Non-US assignees
     :year: string format
     :k: (optional) int, specifying the number of top assignees to include in the map
-    :zoom_on: (latitude, longitude, zoom) specifying the initial position of the map (by default: World)
+    :binned: if True, the locations are binned into grid cells at the highest zoom level of the map (see pipeline.bin_locations)
     
     Outputs
-    :num_inventors: (only if k is not None) sum of number of inventors in year for the top k assignees
+    :locations: locations to draw, in the format required by Folium, None if there is no heat map to draw
+    :df: (None if k is None) dataframe listing the top k assignees and their number of patent applications
+    :num_inventors: (None if k is None) sum of number of inventors in year for the top k assignees
+    :min_opacity: minimum opacity of the heat map
     """
-    
-    blur = 5
-    radius = 5
-    min_opacity = 0.2
-    max_val = 1
-
-    if (zoom_on):
-        center = (zoom_on[0], zoom_on[1])
-        zoom_start = zoom_on[2]
-    else:
-        center = (30,15)
-        zoom_start = 1.75
-    
-    map_ = folium.Map(center, zoom_start = zoom_start, prefer_canvas = False, width= 1000, height = 600,
-                      min_zoom = 2, max_zoom = 5, no_wrap = True, max_bounds = True, min_lat = -60, 
-                      max_lat = 80, zoom_control = False)
+    year_data = full_year_data[str(year)]
+    locations = None
+    df = None
+    num_inventors = None
+    min_opacity = HEATMAP_OPTIONS['min_opacity']
     
     if viz == 'All':
     
         if (k):
-            locations, df, num_inventors = get_top_k_locations(full_year_data[str(year)]['assignees'], k)
-            # save dataframe to csv
-            df.to_csv(viz + '_' + str(year) + '.csv')
+            locations, df, num_inventors = get_top_k_locations(year_data['assignees'], k, year_data)
         else:
-            locations = get_all_locations(full_year_data[str(year)]['locations'])
-
-        plugins.HeatMap(locations, radius = radius, blur = blur, show = True,
-                        min_opacity = min_opacity, max_val = max_val).add_to(map_)
+            locations = get_all_locations(year_data['locations'])
                     
     else:
 
@@ -68,21 +62,115 @@ def get_html(full_year_data, viz, year, k = None, zoom_on = None) :
 
         # also count number of inventors named in patents for the top k assignees            
         if (k):
-            locations, df, num_inventors = get_top_k_locations(full_year_data[str(year)]['assignees'].query(query), k)
-            # save dataframe to csv
-            df.to_csv(viz + '_' + str(year) + '.csv')
-        
-            plugins.HeatMap(locations, radius = radius, blur = blur, show = True,
-                            min_opacity = min_opacity + 0.2, max_val = max_val).add_to(map_)
+            locations, df, num_inventors = get_top_k_locations(year_data['assignees'].query(query), k, year_data)
+            min_opacity += 0.2
+    
+    if (binned) and (locations is not None):
+        locations = bin_locations(locations, MAX_ZOOM)
+    
+    return locations, df, num_inventors, min_opacity
+
+
+def render_map(locations, name, zoom_on = None, min_opacity = HEATMAP_OPTIONS['min_opacity']):
+    """
+    Produce HTML rendering of Folium map of the given locations, and saves it to working directory
+    
+    Inputs
+    :locations: locations to draw, as returned by get_map_locations, None for an empty map
+    :name: string format, name of HTML file to which to save the map
+    :zoom_on: (latitude, longitude, zoom) specifying the initial position of the map (by default: World)
+    :min_opacity: minimum opacity of the heat map
+    """
+    if (zoom_on):
+        center = (zoom_on[0], zoom_on[1])
+        zoom_start = zoom_on[2]
+    else:
+        center = (30,15)
+        zoom_start = 1.75
+    
+    map_ = folium.Map(center, zoom_start = zoom_start, prefer_canvas = False, width= 1000, height = 600,
+                      min_zoom = 2, max_zoom = MAX_ZOOM, no_wrap = True, max_bounds = True, min_lat = -60, 
+                      max_lat = 80, zoom_control = False)
+    
+    if (locations is not None):
+        plugins.HeatMap(locations, radius = HEATMAP_OPTIONS['radius'], blur = HEATMAP_OPTIONS['blur'], show = True,
+                        min_opacity = min_opacity, max_val = HEATMAP_OPTIONS['max_val']).add_to(map_)
 
     # save map to html file
-    map_.save(viz + '_' + str(year) + '.html')
+    map_.save(name + '.html')
+
+
+@metrics.timed('get_html')
+def get_html(full_year_data, viz, year, k = None, zoom_on = None, binned = False) :
+    """
+    Produce HTML rendering of Folium map
+    
+    Inputs
+    :full_year_data: required data for plotting the map
+    :viz: string format, whether to include All, US, or Non-US assignees
+    :year: string format
+    :k: (optional) int, specifying the number of top assignees to include in the map
+    :zoom_on: (latitude, longitude, zoom) specifying the initial position of the map (by default: World)
+    :binned: if True, the locations are binned into grid cells at the highest zoom level of the map (see pipeline.bin_locations),
+             so that the size of the HTML file is bounded by the number of cells instead of the number of locations
+    
+    Outputs
+    :num_inventors: (only if k is not None) sum of number of inventors in year for the top k assignees
+    """
+    locations, df, num_inventors, min_opacity = get_map_locations(full_year_data, viz, year, k, binned)
+    
+    if (k):
+        # save dataframe to csv
+        df.to_csv(viz + '_' + str(year) + '.csv')
+    
+    render_map(locations, viz + '_' + str(year), zoom_on, min_opacity)
     
     if (k):     
         return num_inventors
 
 
-def get_timeseries_fig(full_year_data, year_range, num_inventors_top_10_us, num_inventors_top_10_nonus):
+@metrics.timed('render_maps')
+def render_maps(full_year_data, jobs, workers = 4, binned = False):
+    """
+    Produce the HTML renderings of several Folium maps at once, as get_html would one after the other.
+    The locations of all the maps are computed first, then the maps are rendered and saved in parallel by a pool of processes,
+    which only receive the locations to draw, instead of the whole dataset.
+    
+    Inputs
+    :full_year_data: required data for plotting the maps
+    :jobs: list of (viz, year, k, zoom_on) tuples, one per map, with k and zoom_on as in get_html (None for the default)
+    :workers: int, number of processes rendering the maps
+    :binned: if True, the locations are binned into grid cells (see get_html)
+    
+    Outputs
+    :num_inventors: dictionary, format {(viz, year) : sum of number of inventors in year for the top k assignees}, for the jobs with a k
+    """
+    names = []
+    all_locations = []
+    zooms = []
+    opacities = []
+    num_inventors = {}
+    
+    for viz, year, k, zoom_on in jobs:
+        locations, df, num_inventors_top, min_opacity = get_map_locations(full_year_data, viz, year, k, binned)
+        if (k):
+            df.to_csv(viz + '_' + str(year) + '.csv')
+            num_inventors[(viz, year)] = num_inventors_top
+        
+        names.append(viz + '_' + str(year))
+        all_locations.append(locations)
+        zooms.append(zoom_on)
+        opacities.append(min_opacity)
+    
+    with ProcessPoolExecutor(max_workers = workers) as executor:
+        # consume the results, so that errors in the processes are raised here
+        list(executor.map(render_map, all_locations, names, zooms, opacities))
+    
+    return num_inventors
+
+
+@metrics.timed('get_timeseries_fig')
+def get_timeseries_fig(full_year_data, year_range, num_inventors_top_10_us, num_inventors_top_10_nonus, metrics_table = None):
     """
     Produces a figure with various time series plots and saves to working directory:
     - Number of utility patents vs design patents vs other patents
@@ -96,10 +184,14 @@ def get_timeseries_fig(full_year_data, year_range, num_inventors_top_10_us, num_
     :year_range: range type, from the first to the last year for which there is data in full_year_data
     :num_inventors_top_10_us: time series of data which is returned by get_html() when passing a value for the top K US assignees
     :num_inventors_top_10_nonus: same as previous, but for top K Non-US assignees
+    :metrics_table: (optional) summary metrics of all years, as returned by pipeline.get_metrics_table, built from full_year_data by default
     """
     
-    # get the time series data
-    patents_ts, inventors_ts, citations_ts, utility_ts, design_ts, individuals_ts = get_ts(full_year_data)
+    # get the time series data, from the table of the metrics computed at preprocessing
+    if (metrics_table is None):
+        metrics_table = get_metrics_table(full_year_data)
+    patents_ts, inventors_ts, citations_ts, utility_ts, design_ts, individuals_ts = get_ts(full_year_data, metrics_table)
+    other_ts = metrics_table['other_patents'].values / 1000
     num_inventors_top_10_us = np.array(num_inventors_top_10_us) / 1000
     num_inventors_top_10_nonus = np.array(num_inventors_top_10_nonus) / 1000
     
@@ -116,7 +208,7 @@ def get_timeseries_fig(full_year_data, year_range, num_inventors_top_10_us, num_
     ax0.set_title("All Numbers in [000's]", size = 20)
 
     # BASE PATENTS
-    ax0.stackplot(year_range, utility_ts, design_ts, patents_ts - utility_ts - design_ts,
+    ax0.stackplot(year_range, utility_ts, design_ts, other_ts,
                   colors = ['#377EB8','#55BA87','#7E1137'],
                   labels = ['Number of Utility Patents', ' Design Patents', 'Other Patents'])
 
@@ -158,6 +250,7 @@ def get_timeseries_fig(full_year_data, year_range, num_inventors_top_10_us, num_
     plt.close()
 
 
+@metrics.timed('get_assignees_plot')
 def get_assignees_plot(full_year_data, assignees_us, assignees_nonus):
     """
     Produces a figure comparing the time series plots of the number of inventors for two lists of assignees, and saves to working directory.
@@ -167,9 +260,10 @@ def get_assignees_plot(full_year_data, assignees_us, assignees_nonus):
     :assignees_us: list of assignee names, to plot on the first part
     :assignees_nonus: list of assignee names, to plot on the second part
     """
-    # get time series of number of inventors
-    ts_us = get_assignee_ts(full_year_data, assignees_us)
-    ts_nonus = get_assignee_ts(full_year_data, assignees_nonus)
+    # get time series of number of inventors, from a single table of all the assignees
+    table = get_assignee_table(full_year_data)
+    ts_us = get_assignee_ts(full_year_data, assignees_us, table)
+    ts_nonus = get_assignee_ts(full_year_data, assignees_nonus, table)
     
     # plot figure
     fig = plt.figure(figsize=(24,10))
@@ -198,7 +292,8 @@ FUNCTIONS TO PRODUCE VISUALIZATIONS
 FUNCTIONS FOR PART 2
 """
 
-def save_layers(layers_data, name, zoom_on = None, layered = True):
+@metrics.timed('save_layers')
+def save_layers(layers_data, name, zoom_on = None, layered = True, binned = False):
     """
     Produce HTML rendering of Folium map, with layer control (produces one file) or without layer control (produces number of files = number of layers).
     
@@ -207,11 +302,13 @@ def save_layers(layers_data, name, zoom_on = None, layered = True):
     :name: string format, name of HTML file to which to save the map
     :zoom_on: (latitude, longitude, zoom) specifying the initial position of the map (by default: World)
     :layered: whether to add layer control to a single map, or produce many maps without layer control
+    :binned: if True, the inventor locations are binned into grid cells at the highest zoom level of the map (see pipeline.bin_locations)
     """
     blur = 2
     radius = 5
     min_opacity = 0.5
     max_val = 1
+    max_zoom = 2
     
     if (zoom_on):
         center = (zoom_on[0], zoom_on[1])
@@ -223,18 +320,20 @@ def save_layers(layers_data, name, zoom_on = None, layered = True):
     if (layered):
         # produce a single map
         map_ = folium.Map(center, zoom_start = zoom_start, width= 960, height = 600,
-                          min_zoom = 2, max_zoom = 2, no_wrap = True, max_bounds = True, min_lat = -60, 
+                          min_zoom = 2, max_zoom = max_zoom, no_wrap = True, max_bounds = True, min_lat = -60, 
                           max_lat = 80, zoom_control = False)
     
     for layer in layers_data:
         if layered == False:
             # produce one map for each layer
             map_ = folium.Map(center, zoom_start = zoom_start, width= 960, height = 600,
-                              min_zoom = 2, max_zoom = 2, no_wrap = True, max_bounds = True, 
+                              min_zoom = 2, max_zoom = max_zoom, no_wrap = True, max_bounds = True, 
                               min_lat = -60, max_lat = 80, zoom_control = False)
             
         # for each layer, get the list of inventor locations
         locations = layers_data[layer]['inventors'].values
+        if (binned):
+            locations = bin_locations(locations, max_zoom)
         # draw heat map
         plugins.HeatMap(locations, radius = radius, blur = blur, show = False,
                         min_opacity = min_opacity, max_val = max_val, name = layer).add_to(map_)
@@ -249,50 +348,23 @@ def save_layers(layers_data, name, zoom_on = None, layered = True):
         map_.save(name + '.html')
 
 
-def compute_similarities(layers_data1, layers_data2, name):
+@metrics.timed('compute_similarities')
+def compute_similarities(layers_data1, layers_data2, name, jaccard = False):
     """
     Produce HTML table containing the percentage of similarities in patent citations between two patent networks, at each layer
     
     Inputs
     :layers_data*: sets to compare, as returned when calling load_layers_data from pipeline module
     :name: string format, name of HTML file to which to save the table
+    :jaccard: if True, the table also contains the jaccard similarity of the networks (see similarity.compare_networks)
     """
     
-    if len(layers_data1) < len(layers_data2):
-	    layers_range = layers_data1.keys()
-    else:
-	    layers_range = layers_data2.keys()
-	
-    similarities = []
-    unique_patents_list = []
-    data1_patents_list = []
-    data2_patents_list = []
-    
-    for layer in layers_range:
-	    for citation in layers_data1[layer]['cited_patents']:
-	        if citation not in unique_patents_list:
-	            unique_patents_list.append(citation)
-	        if citation not in data1_patents_list:
-	            data1_patents_list.append(citation)
-	            
-	    for citation in layers_data2[layer]['cited_patents']:
-	        if citation not in unique_patents_list:
-	            unique_patents_list.append(citation)
-	        if citation not in data2_patents_list:
-	            data2_patents_list.append(citation)
-	            
-	    layer_similarities = 0
-	    for citation in unique_patents_list:
-	        if (citation in data1_patents_list) and (citation in data2_patents_list):
-	            layer_similarities += 1
-	    
-	    length = min(len(data1_patents_list), len(data2_patents_list))
-	    similarities.append(layer_similarities/length)
+    similarities = compare_networks(layers_data1, layers_data2)
+    columns = ['Similarity', 'Jaccard'] if jaccard else ['Similarity']
     
     text_file = open(name + '.html', "w")
-    text_file.write(pd.DataFrame({'Similarity' : similarities}, 
-	                             index = layers_range).to_html(index = True,
-	                                                           justify = 'left'))
+    text_file.write(similarities[columns].to_html(index = True,
+                                                  justify = 'left'))
     text_file.close()
 	
 	